@@ -0,0 +1,130 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timezone
+
+logger = logging.getLogger("app_logger")
+
+# Where the YouTube API responses are stored.
+API_CACHE_DIR = "api_cache"
+
+# off:    the API is called without the cache.
+# record: the API is called and every response is stored in the cache.
+# replay: the responses are read from the cache only, no network and no quota is used.
+CACHE_MODES = ["off", "record", "replay"]
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+# Stores one API item per (resource, part, id) as a gzipped JSON file named by the hash of the request.
+# Ids that YouTube didn't return are stored too, so that the deletions can be replayed.
+# Because the items are stored per id, a replay works even if the ids are batched differently.
+class ResponseCache:
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or os.getenv("YOUTUBE_API_CACHE_DIR") or API_CACHE_DIR
+
+    def get_path(self, resource, part, api_id):
+        key = hashlib.sha256(json.dumps([resource, part, api_id]).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json.gz")
+
+    # Returns the stored entry, or None if the request has not been recorded.
+    def load(self, resource, part, api_id):
+        path = self.get_path(resource, part, api_id)
+
+        if not os.path.exists(path):
+            return None
+
+        with gzip.open(path, "rt", encoding="utf-8") as file:
+            return json.load(file)
+
+    def store(self, resource, part, api_id, item):
+        path = self.get_path(resource, part, api_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        entry = {
+            "resource": resource,
+            "part": part,
+            "id": api_id,
+            "fetched_at": datetime.now(timezone.utc).isoformat(),
+            "item": item,
+        }
+
+        # Written into a temporary file first, so that a crash or a parallel write never leaves a broken file.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with gzip.open(os.fdopen(fd, "wb"), "wt", encoding="utf-8") as file:
+                json.dump(entry, file)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+# Wraps the YouTube API client so that videos().list(...).execute() goes through the cache.
+# With replay=True no client is needed.
+class CachingYouTubeClient:
+
+    def __init__(self, client=None, cache=None, replay=False):
+        self.client = client
+        self.cache = cache or ResponseCache()
+        self.replay = replay
+
+        # Replayed requests cost no quota, and the replayed statistics are not today's.
+        self.uses_quota = not replay
+        self.live_statistics = not replay
+
+    def videos(self):
+        return CachedResource(self, "videos")
+
+    def channels(self):
+        return CachedResource(self, "channels")
+
+
+class CachedResource:
+
+    def __init__(self, owner, resource):
+        self.owner = owner
+        self.resource = resource
+
+    def list(self, **params):
+        return CachedRequest(self.owner, self.resource, params)
+
+
+class CachedRequest:
+
+    def __init__(self, owner, resource, params):
+        self.owner = owner
+        self.resource = resource
+        self.params = params
+
+    def execute(self, **kwargs):
+        cache = self.owner.cache
+        part = self.params["part"]
+        api_ids = self.params["id"].split(",")
+
+        if self.owner.replay:
+            items = []
+            for api_id in api_ids:
+                entry = cache.load(self.resource, part, api_id)
+
+                if entry is None:
+                    raise CacheMiss(f"{self.resource} {api_id} ({part}) is not in the cache")
+
+                if entry["item"] is not None:
+                    items.append(entry["item"])
+
+            return {"items": items}
+
+        response = getattr(self.owner.client, self.resource)().list(**self.params).execute(**kwargs)
+
+        items = {item["id"]: item for item in (response or {}).get("items") or []}
+        for api_id in api_ids:
+            cache.store(self.resource, part, api_id, items.get(api_id))
+
+        return response
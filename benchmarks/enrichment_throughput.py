@@ -0,0 +1,91 @@
+# Measures the YouTube enrichment of save_video_details() against the local fake API.
+# Run from the app directory: python -m benchmarks.enrichment_throughput [--videos 100000] [--latency 0.05]
+
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+from create_database import create_database
+from db_connection import apply_profile
+from fake_youtube_api import FakeYouTubeClient
+from youtube_api import MAX_WORKERS, save_video_details
+
+
+# Counts the commits done by the enrichment.
+class CountingConnection(sqlite3.Connection):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.commit_count = 0
+
+    def commit(self):
+        self.commit_count += 1
+        super().commit()
+
+
+def populate_database(conn, c, video_count, videos_per_channel=50):
+
+    channel_count = (video_count + videos_per_channel - 1) // videos_per_channel
+
+    c.executemany("INSERT INTO channel (id, name, url) VALUES (?, ?, ?)",
+                  [(i, f"Channel {i}", f"https://www.youtube.com/channel/UC{i:022d}") for i in range(1, channel_count + 1)])
+
+    c.executemany("INSERT INTO video (id, channel_id, title, url) VALUES (?, ?, ?, ?)",
+                  [(i, (i - 1) // videos_per_channel + 1, f"Video {i}", f"https://www.youtube.com/watch?v=V{i:010d}")
+                   for i in range(1, video_count + 1)])
+
+    conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="YouTube enrichment throughput against the fake API")
+    parser.add_argument("--videos", type=int, default=100_000)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per request")
+    parser.add_argument("--missing-rate", type=float, default=0.01)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        conn = sqlite3.connect(os.path.join(tmp_dir, "benchmark.db"), factory=CountingConnection)
+        c = conn.cursor()
+
+        create_database(conn, c)
+        populate_database(conn, c, args.videos)
+        apply_profile(conn, "enrichment")
+
+        youtube = FakeYouTubeClient(latency=args.latency, missing_rate=args.missing_rate,
+                                    error_rate=args.error_rate, seed=0)
+        conn.commit_count = 0
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        # The budget is big enough for all the videos.
+        save_video_details(youtube, conn, c, quota_budget=args.videos)
+        seconds = time.perf_counter() - start
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        requests = youtube.requests
+        c.execute("SELECT COUNT(*) FROM video_stat")
+        stats = c.fetchone()[0]
+        c.execute("SELECT COUNT(*) FROM video WHERE length IS NOT NULL")
+        updated = c.fetchone()[0]
+        deleted = args.videos - c.execute("SELECT COUNT(*) FROM video").fetchone()[0]
+        commits = conn.commit_count
+
+        conn.close()
+
+    print(f"Videos:        {args.videos} ({updated} updated, {deleted} deleted)")
+    print(f"Workers:       {MAX_WORKERS}, latency {args.latency * 1000:.0f} ms per request")
+    print(f"Time:          {seconds:.2f} s")
+    print(f"Requests:      {requests} ({requests / seconds:,.1f} per second)")
+    print(f"Rows:          {(updated + deleted) / seconds:,.0f} per second ({stats} statistics rows)")
+    print(f"Commits:       {commits}")
+    print(f"Peak memory:   {peak_memory / 1024 / 1024:.1f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# Measures how long importing each app module takes in a fresh interpreter, and which heavy
+# libraries get imported with it. The heavy libraries should be imported only when their step runs.
+# Run from the app directory: python -m benchmarks.import_time
+
+import subprocess
+import sys
+
+MODULES = ["sql_queries", "db_connection", "create_database", "import_data_into_db", "update_keywords",
+           "youtube_api", "dynamic_clustering", "fixed_clustering", "main"]
+
+HEAVY_LIBRARIES = ["nltk", "sklearn", "openai", "googleapiclient", "pandas"]
+
+# Importing these must not import any of the heavy libraries.
+LIGHT_MODULES = ["sql_queries"]
+
+MEASURE_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+loaded = [name for name in {heavy!r} if name in sys.modules]
+print(f"{{seconds}}|{{','.join(loaded)}}")
+"""
+
+
+def measure_import(module):
+    result = subprocess.run([sys.executable, "-c", MEASURE_SCRIPT.format(module=module, heavy=HEAVY_LIBRARIES)],
+                            capture_output=True, text=True)
+
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+
+    seconds, _, loaded = result.stdout.strip().splitlines()[-1].partition("|")
+    return float(seconds), loaded
+
+
+def main():
+    failed = []
+
+    for module in MODULES:
+        seconds, loaded = measure_import(module)
+
+        if seconds is None:
+            print(f"{module:22} import failed: {loaded}")
+            continue
+
+        print(f"{module:22} {seconds * 1000:8.0f} ms   heavy libraries: {loaded or '-'}")
+
+        if module in LIGHT_MODULES and loaded:
+            failed.append(module)
+
+    if failed:
+        raise SystemExit(f"Heavy libraries imported by {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# Compares TextNormalizer with the earlier tokenize_text implementation, which did all the setup on every call.
+# Needs the NLTK data used by update_keywords.py.
+# Run from the app directory: python -m benchmarks.text_normalizer [text count]
+
+import random
+import re
+import string
+import sys
+import time
+
+from nltk.stem import WordNetLemmatizer
+from nltk.tokenize import word_tokenize
+
+from update_keywords import CUSTOM_STOPWORDS, TextNormalizer, get_english_stopwords
+
+WORDS = ("music guitar lesson cats dogs running games gaming played playing recipes cooking kitchen travel "
+         "videos news football highlights science physics history documentary review reviews camera phones "
+         "the a of and to in is with for on this that best official channel subscribe watch new").split()
+
+EXTRAS = ["2023", "#shorts", "(Official Video)", "https://example.com/watch?v=abc123", "¹²", "café", "—", "100%", "&"]
+
+
+# tokenize_text before TextNormalizer, with the ordered duplicate removal.
+def legacy_tokenize_text(text):
+    text = text.lower()
+    text = "".join(c for c in text if c not in string.punctuation and not c.isdigit())
+    text = re.sub(r"http\S+", "", text)
+    tokens = word_tokenize(text)
+    tokens = [word for word in tokens if word not in get_english_stopwords()]
+    tokens = [word for word in tokens if len(word) > 1]
+    lemmatizer = WordNetLemmatizer()
+    tokens = [lemmatizer.lemmatize(word) for word in tokens]
+    tokens = [word for word in tokens if word not in CUSTOM_STOPWORDS]
+    tokens = dict.fromkeys(tokens)
+    return " ".join(tokens)
+
+
+def generate_texts(count, seed=0):
+    rng = random.Random(seed)
+    texts = []
+
+    for _ in range(count):
+        words = [rng.choice(WORDS).capitalize() if rng.random() < 0.2 else rng.choice(WORDS)
+                 for _ in range(rng.randrange(5, 60))]
+        for _ in range(rng.randrange(3)):
+            words.insert(rng.randrange(len(words)), rng.choice(EXTRAS))
+        texts.append(" ".join(words))
+
+    return texts
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20_000
+
+    texts = generate_texts(count)
+    token_count = sum(len(text.split()) for text in texts)
+
+    start = time.perf_counter()
+    legacy = [legacy_tokenize_text(text) for text in texts]
+    legacy_seconds = time.perf_counter() - start
+
+    normalizer = TextNormalizer()
+    start = time.perf_counter()
+    fast = [normalizer.normalize(text) for text in texts]
+    fast_seconds = time.perf_counter() - start
+
+    if fast != legacy:
+        raise SystemExit("TextNormalizer output differs from the legacy tokenize_text")
+
+    print(f"Texts normalized: {count} ({token_count} tokens)")
+    print(f"legacy:          {legacy_seconds:.2f} s ({token_count / legacy_seconds:,.0f} tokens per second)")
+    print(f"TextNormalizer:  {fast_seconds:.2f} s ({token_count / fast_seconds:,.0f} tokens per second)")
+    print(f"Speedup:         {legacy_seconds / fast_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
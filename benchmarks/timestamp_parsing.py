@@ -0,0 +1,55 @@
+# Compares the fast Takeout timestamp parser with dateutil.
+# Run from the app directory: python -m benchmarks.timestamp_parsing [entry count]
+
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+from dateutil.parser import parse
+
+from convert_json_into_csv import format_timestamp
+
+
+def generate_timestamps(count, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    timestamps = []
+
+    for _ in range(count):
+        moment = start + timedelta(seconds=rng.randrange(8 * 365 * 86400))
+        millis = rng.randrange(1000)
+
+        # Takeout drops the fraction now and then.
+        if millis == 0:
+            timestamps.append(moment.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        else:
+            timestamps.append(moment.strftime("%Y-%m-%dT%H:%M:%S") + f".{millis:03d}Z")
+
+    return timestamps
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+
+    timestamps = generate_timestamps(count)
+
+    start = time.perf_counter()
+    fast = [format_timestamp(value) for value in timestamps]
+    fast_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    slow = [parse(value).strftime("%Y-%m-%d %H:%M:%S") for value in timestamps]
+    slow_seconds = time.perf_counter() - start
+
+    if fast != slow:
+        raise SystemExit("Fast parser output differs from dateutil")
+
+    print(f"Timestamps parsed: {count}")
+    print(f"dateutil:     {slow_seconds:.2f} s ({count / slow_seconds:,.0f} per second)")
+    print(f"fast parser:  {fast_seconds:.2f} s ({count / fast_seconds:,.0f} per second)")
+    print(f"Speedup:      {slow_seconds / fast_seconds:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,12 @@
+import csv
+import io
 import json
 import logging
 import os
-import pandas as pd
+import re
+import zipfile
+from contextlib import contextmanager
+from datetime import date
 from tqdm import tqdm
 from dateutil.parser import parse
 
@@ -9,66 +14,266 @@ logger = logging.getLogger("app_logger")
 
 JSON_FILENAME = "watch-history.json"
 
+CSV_COLUMNS = ["Timestamp", "Action", "Title", "URL", "Channel", "Channel URL"]
+
+# How many characters are read from the JSON file at a time.
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Takeout timestamps look like "2023-04-18T15:46:01.546Z", other formats are parsed with dateutil.
+ISO_TIMESTAMP_PATTERN = re.compile(
+    r"(\d{4}-(?:0[1-9]|1[0-2])-(?:0[1-9]|[12]\d|3[01]))T((?:[01]\d|2[0-3]):[0-5]\d:[0-5]\d)(?:\.\d+)?(?:Z|[+-]\d{2}:?\d{2})?", re.ASCII)
+
+# How many rows are buffered before they are written into the CSV file.
+WRITE_CHUNK_SIZE = 10000
+
 
 def convert_json_into_csv():
 
     csv_file =os.getenv("CSV_FILE")
 
     logger.info(f"Start converting {JSON_FILENAME} into {csv_file}...")
-    
-    with open(JSON_FILENAME, "r", encoding="UTF-8") as file:
-        data = file.read()
 
-    df = get_json_data_into_dataframe(data)
-    
+    rows = iter_watch_history(JSON_FILENAME)
+
+    row_count = write_rows_into_csv(rows, csv_file)
+
+    logger.info(f"{row_count} videos added in {csv_file}")
+
+
+# Writes the rows into the CSV file in chunks so that the whole history is never kept in memory.
+def write_rows_into_csv(rows, csv_file, chunk_size=WRITE_CHUNK_SIZE):
+
+    row_count = 0
+
+    for _ in tee_rows_into_csv(rows, csv_file, chunk_size):
+        row_count += 1
+
+    return row_count
+
+
+# Passes the rows through and writes a copy of them into the CSV file on the way.
+def tee_rows_into_csv(rows, csv_file, chunk_size=WRITE_CHUNK_SIZE):
+
     # utf-8-sig includes emojis, not sure if needed.
-    df.to_csv(csv_file, sep=";", index=False, encoding="utf-8-sig")
-    
-    logger.info(f"{len(df)} videos added in {csv_file}")
+    with open(csv_file, "w", encoding="utf-8-sig", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=CSV_COLUMNS, delimiter=";")
+        writer.writeheader()
+
+        chunk = []
+        for row in rows:
+            yield row
+
+            chunk.append(row)
+
+            if len(chunk) >= chunk_size:
+                writer.writerows(chunk)
+                chunk = []
+
+        writer.writerows(chunk)
 
 
-# Reads the JSON file into a pandas DataFrame. 
+# Reads the JSON file entry by entry and yields the rows to be imported.
 # The code expects that the JSON file contains only "Watched" actions.
-def get_json_data_into_dataframe(json_data):
-    json_list = json.loads(json_data)
-    output = []
+# Takeout lists the newest entries first, so with stop_at, the (timestamp, URL) of the newest entry imported earlier,
+# the reading stops after that entry, at the first older one. See iter_watch_history_entries().
+def iter_watch_history(json_file=JSON_FILENAME, stop_at=None):
+
+    with open_watch_history(json_file) as file:
+        if file is None:
+            logger.info(f"No {JSON_FILENAME} in {json_file}, skipping it")
+            return
+
+        yield from iter_watch_history_entries(iter_json_array(file), stop_at)
+
+
+# Opens the watch history as a text file. The path can be the JSON file itself or a Takeout ZIP archive,
+# which is read without extracting it. Yields None if the archive has no watch history,
+# which is normal for the other parts of an export split into several archives.
+@contextmanager
+def open_watch_history(path):
+
+    if not zipfile.is_zipfile(path):
+        with open(path, "r", encoding="UTF-8") as file:
+            yield file
+        return
+
+    with zipfile.ZipFile(path) as archive:
+        member = get_watch_history_member(archive)
+
+        if member is None:
+            yield None
+            return
+
+        with archive.open(member) as binary_file:
+            yield io.TextIOWrapper(binary_file, encoding="UTF-8")
+
+
+# Returns the path of the watch history inside the Takeout archive, or None.
+def get_watch_history_member(archive):
+
+    members = [name for name in archive.namelist() if os.path.basename(name) == JSON_FILENAME]
+
+    return members[0] if members else None
+
+
+# Converts the raw JSON entries into rows, skipping videos that cannot be imported.
+# The reading stops only if the stop_at entry itself is in the file, which proves that the older entries
+# were imported from the same history. Otherwise, for example with an export of another account, the whole
+# file is read with a warning.
+def iter_watch_history_entries(entries, stop_at=None):
     unavailable_videos = 0
-    videos_total = 0
-    
+    reached_mark = False
+
     # Browse through the JSON entries and extract the relevant information.
-    for item in tqdm(json_list):
-        videos_total += 1
-        
-        formatted_datetime = parse(item["time"]).strftime("%Y-%m-%d %H:%M:%S")
+    for item in tqdm(entries):
 
-        action = "Watched"
-        video_title = item["title"]
+        row = convert_entry(item)
 
-        # Skip videos that have been removed or are not available. 
-        if video_title in ["Watched a video that has been removed", "Visited YouTube Music"]:
+        if row is None:
             unavailable_videos += 1
             continue
 
-        video_title = video_title.replace("Watched ", "")
-        video_url = item["titleUrl"]
+        if stop_at is not None:
+            if (row["Timestamp"], row["URL"]) == stop_at:
+                reached_mark = True
+            elif row["Timestamp"] < stop_at[0]:
+                if reached_mark:
+                    logger.info(f"Reached entries imported earlier ({stop_at[0]}), skipping the rest")
+                    break
 
-        if "subtitles" in item and len(item["subtitles"]) > 0:
-            channel_name = item["subtitles"][0]["name"]
-            channel_url = item["subtitles"][0]["url"]
-        else:
-            unavailable_videos += 1
-            continue
+                logger.warning(f"The newest entry imported earlier ({stop_at[0]} {stop_at[1]}) is not in the file, "
+                               "reading the whole file")
+                stop_at = None
 
-        output.append({
-            "Timestamp": formatted_datetime,
-            "Action": action,
-            "Title": video_title,
-            "URL": video_url,
-            "Channel": channel_name,
-            "Channel URL": channel_url
-        })
+        yield row
 
     if unavailable_videos > 0:
         logger.info(f"{unavailable_videos} unavailable videos skipped")
-    
-    return pd.DataFrame(output)
+
+
+# Returns a row for a single JSON entry, or None if the video is not available.
+def convert_entry(item):
+
+    video_title = item["title"]
+
+    # Skip videos that have been removed or are not available.
+    if video_title in ["Watched a video that has been removed", "Visited YouTube Music"]:
+        return None
+
+    if "subtitles" not in item or len(item["subtitles"]) == 0:
+        return None
+
+    formatted_datetime = format_timestamp(item["time"])
+
+    return {
+        "Timestamp": formatted_datetime,
+        "Action": "Watched",
+        "Title": video_title.replace("Watched ", ""),
+        "URL": item["titleUrl"],
+        "Channel": item["subtitles"][0]["name"],
+        "Channel URL": item["subtitles"][0]["url"]
+    }
+
+
+# Converts the Takeout timestamp into "%Y-%m-%d %H:%M:%S" format.
+# Well-formed ISO 8601 values are sliced directly, which is much faster than parsing them with dateutil.
+def format_timestamp(value):
+
+    match = ISO_TIMESTAMP_PATTERN.fullmatch(value)
+
+    # The pattern allows days up to 31 in every month, so the dates after the 28th are checked,
+    # and the ones that don't exist, like 2023-02-30, are left to dateutil.
+    if match and (match.group(1)[8:] <= "28" or is_valid_date(match.group(1))):
+        return f"{match.group(1)} {match.group(2)}"
+
+    return parse(value).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def is_valid_date(value):
+    try:
+        date.fromisoformat(value)
+    except ValueError:
+        return False
+
+    return True
+
+
+# Yields the elements of a top-level JSON array one at a time.
+# Only the current element and one read chunk are kept in memory.
+def iter_json_array(file, chunk_size=READ_CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    buffer = ""
+    position = 0
+    eof = False
+
+    # Returns the position of the next non-whitespace character, reading more data when needed.
+    def skip_whitespace(buffer, position, eof):
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+
+            if position < len(buffer) or eof:
+                return buffer, position, eof
+
+            data = file.read(chunk_size)
+            buffer, position, eof = data, 0, not data
+
+    buffer, position, eof = skip_whitespace(buffer, position, eof)
+
+    if buffer[position:position + 1] != "[":
+        raise ValueError("The JSON file does not contain an array")
+
+    position += 1
+    expect_element = True
+    after_comma = False
+
+    while True:
+        buffer, position, eof = skip_whitespace(buffer, position, eof)
+
+        if position >= len(buffer):
+            raise ValueError("The JSON array is not closed")
+
+        # Like json.loads, a ',' before the ']' is an error, for example in a truncated or corrupt export.
+        if buffer[position] == "]":
+            if after_comma:
+                raise ValueError("Expected a value after ',' in the JSON array, got ']'")
+            return
+
+        if not expect_element:
+            if buffer[position] != ",":
+                raise ValueError(f"Expected ',' in the JSON array, got {buffer[position]!r}")
+
+            position += 1
+            expect_element = True
+            after_comma = True
+            continue
+
+        # Decode the next element, reading more data until the element is complete.
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+
+                data = file.read(chunk_size)
+                eof = not data
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+
+            # A number or a literal may continue in the next chunk.
+            if not eof and (end == len(buffer) or buffer[end] not in ",]" and not buffer[end].isspace()):
+                data = file.read(chunk_size)
+                eof = not data
+                buffer = buffer[position:] + data
+                position = 0
+                continue
+
+            break
+
+        yield item
+
+        position = end
+        expect_element = False
+        after_comma = False
@@ -1,6 +1,9 @@
 import logging
 import os
 
+from schema_migrations import (check_query_plans, ensure_full_text_search,
+                               migrate_database)
+
 logger = logging.getLogger("app_logger")
 
 
@@ -11,20 +14,24 @@ def create_database(conn, c):
 
     if len(tables) > 0:
         logger.info("Database already exists, not creating a new one")
-        return
+    else:
+        create_category_table(c)
+        create_channel_table(c)
+        create_video_table(c)
+        create_video_stat_table(c)
+        create_channel_stat_table(c)
+        create_activity_table(c)
         
-    create_category_table(c)
-    create_channel_table(c)
-    create_video_table(c)
-    create_video_stat_table(c)
-    create_channel_stat_table(c)
-    create_activity_table(c)
-    
-    conn.commit()
-    
-    filename = os.getenv("SQLITE_DB_FILE")
-    
-    logger.info(f"Database created successfully ({filename})")
+        conn.commit()
+        
+        filename = os.getenv("SQLITE_DB_FILE")
+        
+        logger.info(f"Database created successfully ({filename})")
+
+    # New and existing databases are upgraded to the latest schema version.
+    migrate_database(conn, c)
+    ensure_full_text_search(conn, c)
+    check_query_plans(c)
     
     
 def create_category_table(c):
@@ -96,4 +103,4 @@ def create_activity_table(c):
                     FOREIGN KEY (video_id) REFERENCES video(id) ON DELETE CASCADE,
                     FOREIGN KEY (channel_id) REFERENCES channel(id) ON DELETE CASCADE
                 )""")
-    
\ No newline at end of file
+
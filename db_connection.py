@@ -0,0 +1,73 @@
+import logging
+import os
+import sqlite3
+from pathlib import Path
+
+logger = logging.getLogger("app_logger")
+
+# PRAGMA settings for the different kinds of work. WAL journal lets the notebooks and
+# SQLite-web read the database while the pipeline is writing into it.
+PROFILES = {
+    # Safe settings for small writes.
+    "default": {
+        "journal_mode": "WAL",
+        "synchronous": "FULL",
+        "foreign_keys": "ON",
+    },
+    # Import, keyword and category steps writing many rows in large transactions.
+    # A crash may lose the last transaction but does not corrupt the database.
+    "bulk-load": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -262144,  # 256 MB
+        "mmap_size": 1073741824,  # 1 GB
+        "temp_store": "MEMORY",
+        "foreign_keys": "ON",
+    },
+    # YouTube API steps writing small batches between network calls.
+    "enrichment": {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "cache_size": -65536,  # 64 MB
+        "foreign_keys": "ON",
+    },
+    # Reports and notebooks. The connection is opened read-only and never blocks the writer.
+    "read-only analytics": {
+        "read_only": True,
+        "cache_size": -131072,  # 128 MB
+        "mmap_size": 1073741824,  # 1 GB
+        "temp_store": "MEMORY",
+        "query_only": "ON",
+    },
+}
+
+
+# Opens a connection to SQLITE_DB_FILE (or db_file) with the settings of the given profile.
+def get_connection(profile="default", db_file=None):
+
+    db_file = db_file or os.getenv("SQLITE_DB_FILE")
+
+    if PROFILES[profile].get("read_only"):
+        conn = sqlite3.connect(f"{Path(db_file).resolve().as_uri()}?mode=ro", uri=True)
+    else:
+        conn = sqlite3.connect(db_file)
+
+    apply_profile(conn, profile)
+
+    return conn
+
+
+# Switches the settings of an open connection, for example between the pipeline steps.
+# Foreign keys can't be switched inside a transaction, so the pending changes are committed first.
+def apply_profile(conn, profile):
+
+    if conn.in_transaction:
+        conn.commit()
+
+    for pragma, value in PROFILES[profile].items():
+        if pragma == "read_only":
+            continue
+
+        conn.execute(f"PRAGMA {pragma} = {value}")
+
+    logger.info(f"Database connection uses the '{profile}' profile")
@@ -2,15 +2,31 @@
 
 import logging
 import os
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
-import openai
-from sklearn.cluster import KMeans
-from sklearn.feature_extraction.text import TfidfVectorizer
 from tqdm import tqdm
 
-from update_keywords import extract_top_keywords
+from feature_store import (ClusterModel, get_channel_features, get_keywords_hash,
+                           load_cluster_model, save_cluster_model)
 
 logger = logging.getLogger("app_logger")
+
+# How many k values are fitted in parallel when searching the optimal number of categories.
+KMEANS_WORKERS = os.cpu_count() or 1
+
+# Above this many channels the k search uses mini-batch k-means, which is much faster on big data.
+MINI_BATCH_THRESHOLD = 10000
+MINI_BATCH_SIZE = 2048
+
+# How many channels are used for the silhouette score.
+SILHOUETTE_SAMPLE_SIZE = 5000
+
+# Share of the clustered channels that can be added, changed or removed before assign_new_channels()
+# refuses to use the stored centroids and all the channels are clustered again.
+CLUSTER_DRIFT_THRESHOLD = 0.2
              
  
 # Gets the most often used keywords from all channels of the category
@@ -25,13 +41,13 @@ def get_top_channel_keywords(conn, cluster, max_keywords=20):
         WHERE cat.cluster_number = ?
     """, (cluster,))
 
-    rows = cursor.fetchall()
-
-    # Combine all keywords from all channels into a single string
-    all_keywords = " ".join([row[0] for row in rows])
+    # Count the keywords channel by channel
+    counts = Counter()
+    for row in cursor:
+        counts.update((row[0] or "").split())
     
     # Extract the most frequent words
-    top_words = extract_top_keywords(all_keywords, max_keywords=max_keywords)
+    top_words = " ".join(word for word, _ in counts.most_common(max_keywords))
     
     return top_words
 
@@ -57,95 +73,228 @@ def update_category_keywords(conn, c):
     
     
 # Divides channels in categories using KMeans clustering
+# The centroids are stored with save_cluster_model(), so that assign_new_channels() can place
+# new channels into the same categories later.
 def clusterize(conn, c, cluster_count):
+
+    # scikit-learn is slow to import, so it's imported only when the step runs.
+    from sklearn.cluster import KMeans
     
     # Delete the contents so that we can start from scratch
     c.execute("DELETE FROM category")
     
-    # get all keywords from all channels
-    c.execute("SELECT id, keywords FROM channel WHERE keywords IS NOT NULL")
-
-    # Fetch all the channel ids and keywords as a list of tuples
-    ids_and_keywords = c.fetchall()
-
-    # Extract the ids and tokens (keywords) from the list of tuples
-    ids = [row[0] for row in ids_and_keywords]
-    tokens = [row[1] for row in ids_and_keywords]
-
-    vectorizer = TfidfVectorizer()
-
-    # Fit the vectorizer using the combined preprocessed data (keywords from all channels)
-    vectorizer.fit(tokens)
+    # The tf-idf matrix of the keywords from all channels, calculated only if the keywords have changed.
+    features = get_channel_features(c)
 
-    # Transform the keywords to a tf-idf matrix
-    tfidf_matrix = vectorizer.transform(tokens)
+    ids = features.ids
+    tfidf_matrix = features.matrix
 
     # Kmeans groups similar data points together.
     kmeans = KMeans(n_clusters=cluster_count, n_init=10, random_state=0).fit(tfidf_matrix)
 
     # The cluster_labels list contains a suitable cluster number for each channel.
-    cluster_labels = kmeans.labels_
-    
-    # Loop over the categories and update the database
-    for i, cluster in enumerate(cluster_labels):
-        
-        # Check if a category with the given cluster number already exists in the table.
-        c.execute(f"SELECT id FROM category WHERE cluster_number = {cluster}")
-        result = c.fetchone()
+    cluster_labels = [int(cluster) for cluster in kmeans.labels_]
 
-        if result is not None:
-            # If the category exists, use its id to update the category_id field in the channels table
-            category_id = result[0]
-        else:
-            # If the category doesn't exist, insert a new row in the categories table with the new cluster number
-            c.execute(f"INSERT INTO category (cluster_number) VALUES ('{cluster}')")
-            
-            # Get the id of the newly inserted row
-            category_id = c.lastrowid
-            
-        # Update the category_id for the current channel
-        c.execute(f"UPDATE channel SET category_id = {category_id} WHERE id = {ids[i]}")
+    # One category for each cluster
+    c.executemany("INSERT INTO category (cluster_number) VALUES (?)",
+                  [(cluster,) for cluster in sorted(set(cluster_labels))])
+
+    c.execute("SELECT cluster_number, id FROM category")
+    category_ids = dict(c.fetchall())
+
+    c.executemany("UPDATE channel SET category_id = ? WHERE id = ?",
+                  [(category_ids[cluster], channel_id) for channel_id, cluster in zip(ids, cluster_labels)])
 
     # Commit the changes to the database
     conn.commit()
 
+    c.execute("SELECT id, keywords FROM channel WHERE keywords IS NOT NULL")
+    channel_hashes = {channel_id: get_keywords_hash(keywords) for channel_id, keywords in c.fetchall()}
+
+    save_cluster_model(ClusterModel(kmeans.cluster_centers_, features.vectorizer, channel_hashes))
+
     logger.info(f"Categories created: {cluster_count}")
     logger.info(f"Category set for {len(cluster_labels)} channels")
+
+
+# Assigns the channels that are new or whose keywords have changed since the last clusterize() to the
+# nearest stored centroid, keeping the existing categories with their ids, keywords and names.
+# Returns False if the channels need a full clusterize() instead: there is no stored model, the categories
+# don't match it, or more than drift_threshold of the clustered channels have been added, changed or removed.
+def assign_new_channels(conn, c, drift_threshold=CLUSTER_DRIFT_THRESHOLD):
+
+    model = load_cluster_model()
+
+    if model is None:
+        logger.info("No stored cluster model, the channels need to be clustered")
+        return False
+
+    c.execute("SELECT id, keywords, category_id FROM channel WHERE keywords IS NOT NULL")
+    channels = c.fetchall()
+
+    keyword_hashes = {channel_id: get_keywords_hash(keywords) for channel_id, keywords, _ in channels}
+
+    # The drift is measured against the last clustering, including the channels already assigned after it.
+    drifted = sum(model.channel_hashes.get(channel_id) != keywords_hash for channel_id, keywords_hash in keyword_hashes.items())
+    removed = len(model.channel_hashes.keys() - keyword_hashes.keys())
+
+    drift = (drifted + removed) / max(len(model.channel_hashes), 1)
+
+    if drift > drift_threshold:
+        logger.info(f"{drifted} new or changed and {removed} removed channels since the last clustering "
+                    f"({drift:.0%} > {drift_threshold:.0%}), the channels need to be clustered again")
+        return False
+
+    c.execute("SELECT cluster_number, id FROM category WHERE cluster_number IS NOT NULL")
+    category_ids = dict(c.fetchall())
+
+    # The categories have been replaced, for example by set_fixed_categories()
+    if not category_ids.keys() >= set(range(len(model.centroids))):
+        logger.info("The categories don't match the stored cluster model, the channels need to be clustered again")
+        return False
+
+    changed = [(channel_id, keywords) for channel_id, keywords, category_id in channels
+               if category_id is None
+               or model.assigned_hashes.get(channel_id, model.channel_hashes.get(channel_id)) != keyword_hashes[channel_id]]
+
+    if changed:
+        from sklearn.metrics import pairwise_distances_argmin
+
+        # The channels are vectorized with the vocabulary of the clustering, so they are comparable with the centroids.
+        tfidf_matrix = model.vectorizer.transform([keywords for _, keywords in changed])
+        clusters = [int(cluster) for cluster in pairwise_distances_argmin(tfidf_matrix, model.centroids)]
+
+        c.execute("CREATE TEMP TABLE channel_assignment (channel_id INTEGER PRIMARY KEY, category_id INTEGER)")
+        c.executemany("INSERT INTO channel_assignment (channel_id, category_id) VALUES (?, ?)",
+                      [(channel_id, category_ids[cluster]) for (channel_id, _), cluster in zip(changed, clusters)])
+
+        c.execute("""UPDATE channel
+                     SET category_id = (SELECT category_id FROM channel_assignment WHERE channel_id = channel.id)
+                     WHERE id IN (SELECT channel_id FROM channel_assignment)""")
+        c.execute("DROP TABLE channel_assignment")
+
+        conn.commit()
+
+        model.assigned_hashes.update((channel_id, keyword_hashes[channel_id]) for channel_id, _ in changed)
+        save_cluster_model(model)
+
+    logger.info(f"Category set for {len(changed)} new or changed channels "
+                f"({drift:.0%} of the channels changed since the last clustering)")
+
+    return True
     
 
 # Plots a graph to find the optimal number of categories
-def find_optimal_cluster_size(c, k_max):
-    c.execute("""SELECT id, keywords
-             FROM channel 
-             WHERE keywords IS NOT NULL""")
+# Returns the number of categories chosen by evaluate_cluster_sizes().
+def find_optimal_cluster_size(c, k_max, workers=KMEANS_WORKERS, mini_batch=None, sample_size=None, score="elbow"):
+    return evaluate_cluster_sizes(c, k_max, workers, mini_batch, sample_size, score)["k"]
+
+
+# Fits k-means for every k from 1 to k_max and picks the elbow point of the inertias, or with
+# score="silhouette" the k with the best silhouette score.
+# The k values are fitted in parallel processes. Above MINI_BATCH_THRESHOLD channels mini-batch k-means
+# is used, and with sample_size the search is done on a random sample of the channels.
+# Returns a report with the chosen k, the scores and the time used for each k.
+def evaluate_cluster_sizes(c, k_max, workers=KMEANS_WORKERS, mini_batch=None, sample_size=None, score="elbow"):
+
+    # The silhouette score needs at least two clusters.
+    if score == "silhouette" and k_max < 2:
+        raise ValueError(f"score=\"silhouette\" needs k_max of at least 2, got {k_max}")
+
+    start = time.perf_counter()
+
+    # The same tf-idf matrix is used by clusterize()
+    tfidf_matrix = get_channel_features(c).matrix
+
+    if sample_size is not None and tfidf_matrix.shape[0] > sample_size:
+        rows = random.Random(0).sample(range(tfidf_matrix.shape[0]), sample_size)
+        tfidf_matrix = tfidf_matrix[sorted(rows)]
+
+    if mini_batch is None:
+        mini_batch = tfidf_matrix.shape[0] > MINI_BATCH_THRESHOLD
+
+    k_values = range(1, k_max+1)
+    with_silhouette = score == "silhouette"
+
+    if workers > 1:
+        # The CPU threads of each fit are divided between the worker processes, so that they don't compete for the cores.
+        threads = max(1, (os.cpu_count() or 1) // workers)
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(fit_cluster_size, tfidf_matrix, k, mini_batch, with_silhouette, threads)
+                       for k in k_values]
+            results = [future.result() for future in tqdm(futures)]
+    else:
+        results = [fit_cluster_size(tfidf_matrix, k, mini_batch, with_silhouette) for k in tqdm(k_values)]
+
+    inertias = [inertia for inertia, _, _ in results]
+
+    if with_silhouette:
+        # The silhouette score is not defined for a single cluster.
+        silhouettes = [silhouette for _, silhouette, _ in results]
+        best_k = max(k_values[1:], key=lambda k: -1 if silhouettes[k-1] is None else silhouettes[k-1])
+    else:
+        # Find elbow point
+        diff = [inertias[i] - inertias[i-1] for i in range(1, len(inertias))]
+        best_k = diff.index(max(diff)) + 1
+
+    report = {
+        "k": best_k,
+        "score": score,
+        "rows": tfidf_matrix.shape[0],
+        "mini_batch": mini_batch,
+        "workers": workers,
+        "inertias": inertias,
+        "silhouettes": [silhouette for _, silhouette, _ in results],
+        "seconds": [seconds for _, _, seconds in results],
+        "total_seconds": time.perf_counter() - start,
+    }
+
+    log_cluster_size_report(report)
+
+    logger.info(f"Optimal cluster size calculated to be {best_k} (max limit was {k_max})")
+    
+    return report
 
-    ids_and_words = c.fetchall()
 
-    words = [row[1] for row in ids_and_words]
+# Fits one k. Runs also in the worker processes, where threads limits the OpenMP and BLAS threads of the fit.
+# Returns the inertia, the silhouette score (if asked and k > 1) and the seconds used.
+def fit_cluster_size(tfidf_matrix, k, mini_batch, with_silhouette, threads=None):
+    from sklearn.cluster import KMeans, MiniBatchKMeans
+    from sklearn.metrics import silhouette_score
+    from threadpoolctl import threadpool_limits
 
-    vectorizer = TfidfVectorizer()
+    start = time.perf_counter()
 
-    # Fit the vectorizer using the combined preprocessed data
-    vectorizer.fit(words)
+    with threadpool_limits(limits=threads):
+        if mini_batch:
+            kmeans = MiniBatchKMeans(n_clusters=k, n_init=3, batch_size=MINI_BATCH_SIZE, random_state=0).fit(tfidf_matrix)
+        else:
+            kmeans = KMeans(n_clusters=k, n_init=10, random_state=0).fit(tfidf_matrix)
 
-    tfidf_matrix = vectorizer.transform(words)
+        # The silhouette score needs at least two clusters, and it is calculated on a sample because it compares
+        # every pair of channels.
+        silhouette = None
+        if with_silhouette and 1 < len(set(kmeans.labels_)) < tfidf_matrix.shape[0]:
+            silhouette = silhouette_score(tfidf_matrix, kmeans.labels_, sample_size=SILHOUETTE_SAMPLE_SIZE, random_state=0)
 
-    inertias = []
-    for k in tqdm(range(1, k_max+1)):
-        kmeans = KMeans(n_clusters=k, n_init=10, random_state=0).fit(tfidf_matrix)
-        inertias.append(kmeans.inertia_)
+    return kmeans.inertia_, silhouette, time.perf_counter() - start
 
-    # Find elbow point
-    diff = [inertias[i] - inertias[i-1] for i in range(1, len(inertias))]
-    elbow_index = diff.index(max(diff)) + 1
 
-    logger.info(f"Optimal cluster size calculated to be {elbow_index} (max limit was {k_max})")
-    
-    return elbow_index
+def log_cluster_size_report(report):
+
+    method = "mini-batch k-means" if report["mini_batch"] else "k-means"
+    logger.info(f"Cluster sizes evaluated with {method} on {report['rows']} channels "
+                f"in {report['total_seconds']:.1f} s ({report['workers']} workers)")
+
+    for k, (inertia, silhouette, seconds) in enumerate(zip(report["inertias"], report["silhouettes"], report["seconds"]), start=1):
+        silhouette_text = f", silhouette {silhouette:.3f}" if silhouette is not None else ""
+        logger.info(f"  k={k}: inertia {inertia:.1f}{silhouette_text}, {seconds:.2f} s")
 
 
 # Asks the OpenAI API to generate a name for each category based on the keywords.
 def get_category_names_from_openai(conn, c):
+    import openai
 
     openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -0,0 +1,119 @@
+import json
+import os
+import random
+import threading
+import time
+import zlib
+
+# A local stand-in for the videos.list and channels.list endpoints of the YouTube Data API.
+# It is meant for the benchmarks and CI. The app uses it with YOUTUBE_API_BACKEND=fake only on a scratch database
+# named also in FAKE_YOUTUBE_DB_FILE, because the made up items would overwrite the real data.
+# The items are generated from the ids, so the same id always gives the same item.
+
+# Seconds each request takes.
+FAKE_LATENCY = 0.05
+
+# Share of the ids that are not returned, like deleted videos and channels.
+FAKE_MISSING_RATE = 0.01
+
+# Share of the requests that fail with HTTP 503.
+FAKE_ERROR_RATE = 0.0
+
+
+# The client is used like the real one, so the requests are charged to the api_quota table and the statistics
+# are stored. The requests are also counted in requests.
+class FakeYouTubeClient:
+
+    def __init__(self, latency=FAKE_LATENCY, missing_rate=FAKE_MISSING_RATE, error_rate=FAKE_ERROR_RATE, seed=None):
+        self.latency = latency
+        self.missing_rate = missing_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    # Reads the settings from FAKE_YOUTUBE_LATENCY, FAKE_YOUTUBE_MISSING_RATE and FAKE_YOUTUBE_ERROR_RATE.
+    @classmethod
+    def from_env(cls):
+        return cls(latency=float(os.getenv("FAKE_YOUTUBE_LATENCY", FAKE_LATENCY)),
+                   missing_rate=float(os.getenv("FAKE_YOUTUBE_MISSING_RATE", FAKE_MISSING_RATE)),
+                   error_rate=float(os.getenv("FAKE_YOUTUBE_ERROR_RATE", FAKE_ERROR_RATE)))
+
+    def videos(self):
+        return FakeResource(self, "videos")
+
+    def channels(self):
+        return FakeResource(self, "channels")
+
+
+class FakeResource:
+
+    def __init__(self, client, resource):
+        self.client = client
+        self.resource = resource
+
+    def list(self, part, id, maxResults=None):
+        return FakeRequest(self.client, self.resource, part.split(","), id.split(","))
+
+
+class FakeRequest:
+
+    def __init__(self, client, resource, parts, api_ids):
+        self.client = client
+        self.resource = resource
+        self.parts = parts
+        self.api_ids = api_ids
+
+    # Takes the same arguments as HttpRequest.execute(), but doesn't use them.
+    def execute(self, http=None, num_retries=0):
+        client = self.client
+
+        with client.lock:
+            client.requests += 1
+
+        time.sleep(client.latency)
+
+        if client.random.random() < client.error_rate:
+            import httplib2
+            from googleapiclient.errors import HttpError
+
+            content = json.dumps({"error": {"code": 503, "message": "Backend Error",
+                                            "errors": [{"reason": "backendError"}]}}).encode("utf-8")
+            raise HttpError(httplib2.Response({"status": 503}), content)
+
+        items = [self.make_item(api_id) for api_id in self.api_ids if not self.is_missing(api_id)]
+
+        return {"kind": f"youtube#{self.resource[:-1]}ListResponse", "items": items}
+
+    def is_missing(self, api_id):
+        return zlib.crc32(api_id.encode("utf-8")) % 10000 < self.client.missing_rate * 10000
+
+    def make_item(self, api_id):
+        number = zlib.crc32(api_id.encode("utf-8"))
+        item = {"kind": f"youtube#{self.resource[:-1]}", "id": api_id}
+
+        if self.resource == "videos":
+            parts = {
+                "snippet": {
+                    "title": f"Video {api_id}",
+                    "description": f"Description of video {api_id} with some words about topic {number % 100}",
+                    "publishedAt": f"20{10 + number % 14}-0{1 + number % 9}-1{number % 10}T12:00:00Z",
+                    "tags": [f"tag{number % 50}", f"topic{number % 100}"],
+                },
+                "contentDetails": {"duration": f"PT{number % 3}H{number % 60}M{number % 59 + 1}S"},
+                "statistics": {"viewCount": str(number % 1000000), "likeCount": str(number % 10000),
+                               "commentCount": str(number % 1000)},
+            }
+        else:
+            parts = {
+                "snippet": {"title": f"Channel {api_id}", "description": f"Description of channel {api_id}"},
+                "contentDetails": {"relatedPlaylists": {"uploads": f"UU{api_id[2:]}"}},
+                "statistics": {"subscriberCount": str(number % 100000), "videoCount": str(number % 1000),
+                               "viewCount": str(number % 10000000)},
+            }
+
+        for part in self.parts:
+            if part in parts:
+                item[part] = parts[part]
+
+        return item
@@ -0,0 +1,213 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger("app_logger")
+
+# Where the TF-IDF matrices are stored between the runs.
+FEATURES_DIR = "features"
+
+
+# TF-IDF features of a set of documents: the row ids, the sparse matrix and the fitted vectorizer.
+class Features:
+
+    def __init__(self, ids, matrix, vectorizer, key):
+        self.ids = ids
+        self.matrix = matrix
+        self.vectorizer = vectorizer
+        self.key = key
+
+
+# TF-IDF of the channel keywords, used by the clustering steps.
+def get_channel_features(c, features_dir=None):
+
+    c.execute("SELECT id, keywords FROM channel WHERE keywords IS NOT NULL ORDER BY id")
+    rows = c.fetchall()
+
+    return get_features("channel_keywords", [row[0] for row in rows], [row[1] for row in rows], features_dir)
+
+
+# TF-IDF of the combined video keywords of each channel, used by the category classifier.
+# The keywords are concatenated in video id order, so that unchanged keywords give the same features key.
+def get_channel_video_features(c, features_dir=None):
+
+    c.execute("""SELECT c.id, GROUP_CONCAT(v.keywords, ' ')
+                 FROM channel AS c
+                 INNER JOIN (SELECT channel_id, keywords FROM video ORDER BY channel_id, id) AS v ON v.channel_id = c.id
+                 GROUP BY c.id
+                 ORDER BY c.id""")
+    rows = c.fetchall()
+
+    return get_features("channel_video_keywords", [row[0] for row in rows], [row[1] or "" for row in rows], features_dir)
+
+
+# Returns the TF-IDF features of the documents. The matrix is stored in features_dir as <name>.npz and the ids,
+# vocabulary and idf weights as <name>.json, with a hash of the documents. If the documents haven't changed
+# since the last run, the stored features are used and nothing is vectorized.
+def get_features(name, ids, documents, features_dir=None):
+
+    features_dir = features_dir or os.getenv("FEATURES_DIR") or FEATURES_DIR
+    key = get_features_key(ids, documents)
+
+    features = load_features(features_dir, name, key)
+
+    if features is not None:
+        logger.info(f"Using stored {name} features ({features.matrix.shape[0]} rows)")
+        return features
+
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer()
+    matrix = vectorizer.fit_transform(documents)
+
+    features = Features(ids, matrix, vectorizer, key)
+    save_features(features_dir, name, features)
+
+    logger.info(f"Calculated {name} features ({matrix.shape[0]} rows, {matrix.shape[1]} words)")
+
+    return features
+
+
+def get_features_key(ids, documents):
+    return hashlib.sha256(json.dumps([ids, documents]).encode("utf-8")).hexdigest()
+
+
+def load_features(features_dir, name, key):
+
+    metadata_path = os.path.join(features_dir, f"{name}.json")
+    matrix_path = os.path.join(features_dir, f"{name}.npz")
+
+    if not os.path.exists(metadata_path) or not os.path.exists(matrix_path):
+        return None
+
+    with open(metadata_path, encoding="utf-8") as file:
+        metadata = json.load(file)
+
+    if metadata["key"] != key:
+        return None
+
+    import numpy as np
+    from scipy import sparse
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer(vocabulary=metadata["vocabulary"])
+    vectorizer.idf_ = np.array(metadata["idf"])
+
+    return Features(metadata["ids"], sparse.load_npz(matrix_path), vectorizer, key)
+
+
+# The old metadata is removed first and the new one written last, so that a crash never leaves
+# a metadata file pointing to a different matrix.
+def save_features(features_dir, name, features):
+
+    from scipy import sparse
+
+    os.makedirs(features_dir, exist_ok=True)
+
+    metadata_path = os.path.join(features_dir, f"{name}.json")
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    write_file(os.path.join(features_dir, f"{name}.npz"), lambda path: sparse.save_npz(path, features.matrix))
+
+    metadata = {
+        "key": features.key,
+        "ids": features.ids,
+        "vocabulary": {word: int(index) for word, index in features.vectorizer.vocabulary_.items()},
+        "idf": features.vectorizer.idf_.tolist(),
+    }
+
+    write_json_file(metadata_path, metadata)
+
+
+# Writes the file through a temporary file with write(path), so that a crash never leaves a half-written file.
+def write_file(path, write):
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=os.path.splitext(path)[1])
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+def write_json_file(path, data):
+
+    def write(tmp_path):
+        with open(tmp_path, "w", encoding="utf-8") as file:
+            json.dump(data, file)
+
+    write_file(path, write)
+
+
+# The k-means model of the latest full clustering: the centroids, the vectorizer the channels were
+# vectorized with and a hash of the keywords of each clustered channel.
+# New and changed channels are assigned to these centroids until the next full clustering, and
+# assigned_hashes has the keyword hashes of the channels assigned since then.
+class ClusterModel:
+
+    def __init__(self, centroids, vectorizer, channel_hashes, assigned_hashes=None):
+        self.centroids = centroids
+        self.vectorizer = vectorizer
+        self.channel_hashes = channel_hashes
+        self.assigned_hashes = assigned_hashes or {}
+
+
+def get_keywords_hash(keywords):
+    return hashlib.blake2b(keywords.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def save_cluster_model(model, features_dir=None):
+
+    import numpy as np
+
+    features_dir = features_dir or os.getenv("FEATURES_DIR") or FEATURES_DIR
+    os.makedirs(features_dir, exist_ok=True)
+
+    metadata_path = os.path.join(features_dir, "cluster_model.json")
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    write_file(os.path.join(features_dir, "cluster_model.npz"), lambda path: np.savez(path, centroids=model.centroids))
+
+    metadata = {
+        "vocabulary": {word: int(index) for word, index in model.vectorizer.vocabulary_.items()},
+        "idf": model.vectorizer.idf_.tolist(),
+        "channel_hashes": {str(channel_id): keywords_hash for channel_id, keywords_hash in model.channel_hashes.items()},
+        "assigned_hashes": {str(channel_id): keywords_hash for channel_id, keywords_hash in model.assigned_hashes.items()},
+    }
+
+    write_json_file(metadata_path, metadata)
+
+
+# Returns the stored ClusterModel, or None if the channels have not been clustered yet.
+def load_cluster_model(features_dir=None):
+
+    features_dir = features_dir or os.getenv("FEATURES_DIR") or FEATURES_DIR
+
+    metadata_path = os.path.join(features_dir, "cluster_model.json")
+    centroids_path = os.path.join(features_dir, "cluster_model.npz")
+
+    if not os.path.exists(metadata_path) or not os.path.exists(centroids_path):
+        return None
+
+    with open(metadata_path, encoding="utf-8") as file:
+        metadata = json.load(file)
+
+    import numpy as np
+    from sklearn.feature_extraction.text import TfidfVectorizer
+
+    vectorizer = TfidfVectorizer(vocabulary=metadata["vocabulary"])
+    vectorizer.idf_ = np.array(metadata["idf"])
+
+    with np.load(centroids_path) as data:
+        centroids = data["centroids"]
+
+    channel_hashes = {int(channel_id): keywords_hash for channel_id, keywords_hash in metadata["channel_hashes"].items()}
+    assigned_hashes = {int(channel_id): keywords_hash for channel_id, keywords_hash in metadata["assigned_hashes"].items()}
+
+    return ClusterModel(centroids, vectorizer, channel_hashes, assigned_hashes)
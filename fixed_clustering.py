@@ -4,17 +4,13 @@ THIS FILE IS USED FOR FIXED CLUSTERING ONLY
 
 import logging
 import os
-
-import openai
-import pandas as pd
-from sklearn.ensemble import RandomForestClassifier
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics import accuracy_score
-from sklearn.model_selection import train_test_split
-from sklearn.pipeline import Pipeline
+import re
+import unicodedata
 
 from tqdm import tqdm
 
+from feature_store import get_channel_video_features
+
 logger = logging.getLogger("app_logger")
 
 # Channels that get easily misclassified. 
@@ -100,7 +96,11 @@ def set_fixed_categories(conn, c, delete_categories=True):
     logger.info("Fixed categories inserted into database")
 
 
-# Set the category_id for channels that contain the specified keyword in their name.
+# Set the category_id for channels that contain the specified keyword in their name or keywords.
+# The words are searched from the channel_fts full-text index: "music" matches also "musician", but
+# a word with spaces around it, like " AI ", matches only the whole word.
+# Without the index (SQLite without FTS5) the names and keywords are scanned with a regular expression
+# that follows the same rule, see get_word_pattern().
 def set_categories_with_keyword(conn, c, words, category):
 
     c.execute("SELECT id FROM category WHERE name = ?", (category,))
@@ -108,42 +108,88 @@ def set_categories_with_keyword(conn, c, words, category):
 
     word_list = words.split(",")
 
+    c.execute("SELECT 1 FROM sqlite_master WHERE name = 'channel_fts'")
+    use_full_text_search = c.fetchone() is not None
+
     # get all channels containing the specified keyword in their name.
     for word in word_list:
-        c.execute(f"SELECT id, name FROM channel WHERE category_id IS NULL AND (LOWER(name) LIKE '%{word.lower()}%' OR LOWER(keywords) LIKE '%{word.lower()}%')")
-
-        channels = c.fetchall()
-        for channel in channels:
-            channel_id = channel[0]
+        if not word.strip():
+            continue
+
+        if use_full_text_search:
+            c.execute("""UPDATE channel SET category_id = ? 
+                         WHERE category_id IS NULL 
+                         AND id IN (SELECT rowid FROM channel_fts WHERE channel_fts MATCH ?)""",
+                      (category_id, get_match_query(word)))
+        else:
+            conn.create_function("REGEXP", 2, matches_pattern, deterministic=True)
 
-            c.execute("UPDATE channel SET category_id = ? WHERE id = ? AND channel.category_id IS NULL", (category_id, channel_id))
+            pattern = get_word_pattern(word)
+            c.execute("""UPDATE channel SET category_id = ? 
+                         WHERE category_id IS NULL 
+                         AND (name REGEXP ? OR keywords REGEXP ?)""",
+                      (category_id, pattern, pattern))
 
     conn.commit()
 
 
+# Returns an FTS5 query for the word or phrase: a prefix query, or an exact one if the word has spaces around it.
+def get_match_query(word):
+
+    phrase = '"' + word.strip().replace('"', '""') + '"'
+
+    if word.startswith(" ") and word.endswith(" "):
+        return phrase
+
+    return phrase + " *"
+
+
+# Returns a regular expression that matches the text like get_match_query() matches the full-text index.
+# The texts are split into words at everything but letters and digits like the FTS5 unicode61 tokenizer,
+# the phrase has to start at a word boundary, and the last word is a prefix unless the word has spaces around it.
+def get_word_pattern(word):
+
+    tokens = re.findall(r"[^\W_]+", fold_text(word))
+    pattern = r"(?<![^\W_])" + r"[\W_]+".join(re.escape(token) for token in tokens)
+
+    if word.startswith(" ") and word.endswith(" "):
+        pattern += r"(?![^\W_])"
+
+    return pattern
+
+
+# Called by SQLite for "text REGEXP pattern".
+def matches_pattern(pattern, text):
+    return text is not None and re.search(pattern, fold_text(text)) is not None
+
+
+# Lowercase without diacritics, like the FTS5 unicode61 tokenizer compares the words.
+def fold_text(text):
+    return "".join(char for char in unicodedata.normalize("NFKD", text.lower()) if not unicodedata.combining(char))
+
+
 # Use Random Forest Classifier to predict the category for channels that have no category set.
 # The model is trained with the channels that were set with the fixed names and keywords.
 def categorize_remaining_channels(conn, c):
-    
-    labeled_channels = pd.read_sql_query("""
-        SELECT c.id, c.category_id, GROUP_CONCAT(v.keywords, ' ') AS keywords
-        FROM channel AS c
-        INNER JOIN category AS cat ON cat.id = c.category_id
-        INNER JOIN video AS v ON v.channel_id = c.id
-        WHERE c.category_id IS NOT NULL
-        GROUP BY c.id, c.category_id;
-        """, conn)
-
-    unlabeled_channels = pd.read_sql_query("""
-        SELECT c.id, c.category_id, GROUP_CONCAT(v.keywords, ' ') AS keywords
-        FROM channel AS c
-        INNER JOIN video AS v ON v.channel_id = c.id
-        WHERE c.category_id IS NULL
-        GROUP BY c.id, c.category_id;
-        """, conn)
-
-    X = labeled_channels["keywords"]
-    y = labeled_channels["category_id"]
+
+    # scikit-learn is slow to import, so it's imported only when the step runs.
+    from sklearn.ensemble import RandomForestClassifier
+    from sklearn.metrics import accuracy_score
+    from sklearn.model_selection import train_test_split
+
+    # The tf-idf matrix of the video keywords of all channels. It's stored between the runs, so rerunning
+    # the categorization with different fixed categories doesn't vectorize the keywords again.
+    features = get_channel_video_features(c)
+
+    c.execute("SELECT id, category_id FROM channel")
+    category_ids = dict(c.fetchall())
+
+    labels = [category_ids.get(channel_id) for channel_id in features.ids]
+    labeled_rows = [i for i, label in enumerate(labels) if label is not None]
+    unlabeled_rows = [i for i, label in enumerate(labels) if label is None]
+
+    X = features.matrix[labeled_rows]
+    y = [labels[i] for i in labeled_rows]
 
     X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.1, random_state=42)
 
@@ -152,40 +198,25 @@ def categorize_remaining_channels(conn, c):
     }
 
     for name, classifier in classifiers.items():
-        pipeline = Pipeline([
-            ("tfidf", TfidfVectorizer()),
-            (name, classifier),
-        ])
-
-        pipeline.fit(X_train, y_train)
+        classifier.fit(X_train, y_train)
 
-        y_pred = pipeline.predict(X_test)
+        y_pred = classifier.predict(X_test)
         logger.info(f"Accuracy: {accuracy_score(y_test, y_pred)}")
 
-    unlabeled_X = unlabeled_channels["keywords"]
-    unlabeled_pred = pipeline.predict(unlabeled_X)
-
-    # Add the predicted categories to the unlabeled_channels DataFrame
-    unlabeled_channels["predicted_category_id"] = unlabeled_pred
-
-    for i, row in enumerate(unlabeled_channels.itertuples()):
-        channel_id = row.id
-        pred_cat_id = int(unlabeled_pred[i])
+    if unlabeled_rows:
+        unlabeled_pred = classifier.predict(features.matrix[unlabeled_rows])
 
-        c.execute("UPDATE channel SET category_id = ? WHERE id = ?", (pred_cat_id, channel_id))
+        c.executemany("UPDATE channel SET category_id = ? WHERE id = ?",
+                      [(int(pred_cat_id), features.ids[i]) for i, pred_cat_id in zip(unlabeled_rows, unlabeled_pred)])
 
     conn.commit()
     
-    logger.info(f"Remaining {len(unlabeled_channels)} channels categorized")
+    logger.info(f"Remaining {len(unlabeled_rows)} channels categorized")
 
 
 # Ask OpenAI to provide keywords based on the category name.
-import os
-
-import openai
-from tqdm import tqdm
-
 def get_category_keywords_from_openai_api(conn, c, num_keywords=16, read_from_cache=False):
+    import openai
 
     openai.api_key = os.getenv("OPENAI_API_KEY")
 
@@ -1,6 +1,14 @@
 import csv
 import logging
 import os
+import re
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+from queue import Empty
+
+from convert_json_into_csv import (JSON_FILENAME, get_watch_history_member, iter_watch_history,
+                                   tee_rows_into_csv)
 
 logger = logging.getLogger("app_logger")
 
@@ -12,6 +20,16 @@ CHANNELS_NOT_TO_IMPORT = ["4k SCREENSAVERS", "Nature Relaxation Films", "4K Rela
 # Some extra long videos can be deleted but in that case these channels won't be touched.
 IMPORTANT_CHANNELS = ["Lex Fridman", "Andrew Huberman"]
 
+# How many new activities are collected before they are inserted into the database.
+IMPORT_BATCH_SIZE = 10000
+
+# How many rows the worker processes send to the importer at a time.
+QUEUE_CHUNK_SIZE = 1000
+
+# Takeout names the archives takeout-<export time>-<part>.zip, so the name changes with every export.
+# The export time and part are left out of the import_state source of an archive.
+TAKEOUT_ARCHIVE_SUFFIX = re.compile(r"-\d{8}T\d{6}Z(-\d+)?(?=\.zip$)", re.IGNORECASE)
+
 
 # Insert the data from the CSV file into the database.
 def insert_data_into_database(conn, c):
@@ -22,110 +40,404 @@ def insert_data_into_database(conn, c):
         
         reader = csv.DictReader(csvfile, delimiter=";")
 
-        inserted_videos = 0
-        inserted_channels = 0
-        inserted_actions = 0
-        skipped_videos = 0
+        insert_rows_into_database(conn, c, reader)
+
+
+# Returns the watch history files listed in TAKEOUT_FILES (comma separated JSON files or Takeout ZIP archives).
+# A file can be given a source name as name=path, see get_import_sources().
+def get_takeout_files():
+
+    takeout_files = os.getenv("TAKEOUT_FILES") or JSON_FILENAME
+
+    return [path.strip() for path in takeout_files.split(",") if path.strip()]
+
+
+# Insert the watch history straight from the JSON files or Takeout ZIP archives into the database, 
+# without the CSV stage. Several files are parsed in parallel processes and merged into the database
+# here, so that there is only one writer.
+# With write_csv the imported rows are also written into CSV_FILE for debugging.
+# With incremental the reading stops at the entries that were imported on earlier runs.
+def import_json_into_database(conn, c, json_files=None, write_csv=False, incremental=True, workers=None):
+
+    if json_files is None:
+        json_files = get_takeout_files()
+    elif isinstance(json_files, str):
+        json_files = [json_files]
+
+    sources = get_import_sources(json_files)
+    json_files = list(sources)
+
+    logger.info(f"Importing {', '.join(json_files)} into the database...")
+
+    high_water_marks = {}
+    for json_file in json_files:
+        high_water_marks[json_file] = get_high_water_mark(c, sources[json_file]) if incremental else None
+
+        if high_water_marks[json_file] is not None:
+            logger.info(f"Importing only entries watched since {high_water_marks[json_file][0]} from {json_file}")
+
+    newest = dict(high_water_marks)
+
+    if len(json_files) == 1:
+        json_file = json_files[0]
+        rows = iter_watch_history(json_file, stop_at=high_water_marks[json_file])
         
-        logger.info("Inserting data into the database...")
+        insert_json_rows(conn, c, track_newest_timestamp(rows, newest, json_file), write_csv)
+    else:
+        workers = workers or min(len(json_files), os.cpu_count() or 1)
+
+        # The manager is shut down first if the import fails, which releases the workers waiting on the queue.
+        with ProcessPoolExecutor(max_workers=workers) as executor, Manager() as manager:
+            queue = manager.Queue(maxsize=workers * 4)
+
+            futures = [executor.submit(read_watch_history_into_queue, json_file, high_water_marks[json_file], queue)
+                       for json_file in json_files]
+
+            insert_json_rows(conn, c, iter_rows_from_queue(queue, futures, newest), write_csv)
+
+    for json_file in json_files:
+        save_high_water_mark(conn, c, sources[json_file], newest[json_file])
+
+
+# Returns {path: source} for the watch history files. The source keys the high-water mark in import_state,
+# so it has to stay the same from one export to the next:
+#  - "name=path" uses the given name, e.g. personal=downloads/takeout-20240101T120000Z-001.zip.
+#    Name the files when you import exports of several accounts.
+#  - A Takeout archive without a name uses its folder, its file name without the export time and part,
+#    and the path of the watch history inside it, e.g. downloads/takeout.zip:Takeout/.../watch-history.json.
+#  - A JSON file without a name uses its path.
+def get_import_sources(json_files):
+
+    sources = {}
+    for entry in json_files:
+        name, separator, path = entry.partition("=")
+
+        if separator:
+            name, path = name.strip(), path.strip()
+        else:
+            name, path = None, entry
+
+        source = name or get_import_source(path)
+
+        if source in sources.values():
+            raise ValueError(f"{path} has the same import source as another file ({source}), "
+                             "give the files their own names as name=path in TAKEOUT_FILES")
+
+        sources[path] = source
+
+    return sources
+
+
+def get_import_source(path):
+
+    if not zipfile.is_zipfile(path):
+        return path
+
+    with zipfile.ZipFile(path) as archive:
+        member = get_watch_history_member(archive)
+
+    # The other parts of a split export have no watch history, and nothing is imported from them.
+    if member is None:
+        return path
+
+    archive_name = TAKEOUT_ARCHIVE_SUFFIX.sub("", os.path.basename(path))
+
+    return f"{os.path.join(os.path.dirname(path), archive_name)}:{member}"
+
+
+def insert_json_rows(conn, c, rows, write_csv):
+
+    if write_csv:
+        csv_file = os.getenv("CSV_FILE")
+        rows = tee_rows_into_csv(rows, csv_file)
+        logger.info(f"Imported rows are written also in {csv_file}")
+
+    insert_rows_into_database(conn, c, rows)
+
+
+# Runs in a worker process. Parses one watch history file and sends the rows in chunks to the queue.
+def read_watch_history_into_queue(json_file, stop_at, queue, chunk_size=QUEUE_CHUNK_SIZE):
+
+    try:
+        chunk = []
+        for row in iter_watch_history(json_file, stop_at=stop_at):
+            chunk.append(row)
+
+            if len(chunk) >= chunk_size:
+                queue.put(("rows", json_file, chunk))
+                chunk = []
+
+        queue.put(("rows", json_file, chunk))
+    except Exception as e:
+        queue.put(("error", json_file, repr(e)))
+        raise
+
+    queue.put(("done", json_file, None))
+
+
+# Yields the rows sent by the worker processes until every file has been read.
+def iter_rows_from_queue(queue, futures, newest):
+
+    finished_files = 0
+    while finished_files < len(futures):
+        try:
+            message, json_file, rows = queue.get(timeout=1)
+        except Empty:
+            # A worker process that died without reporting would leave the import waiting forever.
+            for future in futures:
+                if future.done() and future.exception() is not None:
+                    raise future.exception()
+            continue
+
+        if message == "error":
+            raise RuntimeError(f"Reading {json_file} failed: {rows}")
+
+        if message == "done":
+            finished_files += 1
+            continue
+
+        yield from track_newest_timestamp(rows, newest, json_file)
+
+
+# Passes the rows through and keeps the (timestamp, URL) of the newest row seen in newest[json_file].
+def track_newest_timestamp(rows, newest, json_file):
+
+    for row in rows:
+        if newest[json_file] is None or row["Timestamp"] > newest[json_file][0]:
+            newest[json_file] = (row["Timestamp"], row["URL"])
         
-        # Loop over each row in the CSV file.
-        for row in reader:
+        yield row
+
+
+# Returns the (timestamp, URL) of the newest entry imported from the given source, or None.
+def get_high_water_mark(c, source):
+
+    c.execute("SELECT last_timestamp, last_url FROM import_state WHERE source = ?", (source,))
+    result = c.fetchone()
+
+    return tuple(result) if result else None
+
+
+def save_high_water_mark(conn, c, source, mark):
+
+    if mark is None:
+        return
+
+    c.execute("""INSERT INTO import_state (source, last_timestamp, last_url) VALUES (?, ?, ?)
+                 ON CONFLICT (source) DO UPDATE SET last_timestamp = excluded.last_timestamp, last_url = excluded.last_url""",
+              (source,) + tuple(mark))
+    conn.commit()
+
+
+# Insert the rows (one dict per watched video, keyed like the CSV columns) into the database.
+# Existing channels, videos and activities are loaded into memory once, and new ones are 
+# inserted in batches, so the import time depends only on the number of rows.
+def insert_rows_into_database(conn, c, rows, batch_size=IMPORT_BATCH_SIZE):
+
+    inserted_videos = 0
+    inserted_channels = 0
+    inserted_actions = 0
+    skipped_videos = 0
+    
+    excluded_channels = set(CHANNELS_NOT_TO_IMPORT)
+
+    # The lowest id wins if the same key is in the table more than once.
+    c.execute("SELECT url, id FROM channel ORDER BY id DESC")
+    channel_ids = dict(c.fetchall())
+
+    c.execute("SELECT title, url, id FROM video ORDER BY id DESC")
+    video_ids = {(title, url): video_id for title, url, video_id in c.fetchall()}
+
+    c.execute("SELECT action, timestamp FROM activity")
+    activities = set(c.fetchall())
+
+    next_channel_id = c.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM channel").fetchone()[0]
+    next_video_id = c.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM video").fetchone()[0]
+
+    new_channels = []
+    new_videos = []
+    new_activities = []
+
+    logger.info("Inserting data into the database...")
+    
+    # Loop over each row.
+    for row in rows:
+        
+        if  row["Channel"] in excluded_channels:
+            skipped_videos += 1
+            continue
             
-            if  row["Channel"] in CHANNELS_NOT_TO_IMPORT:
-                skipped_videos += 1
-                continue
-                
-            c.execute("SELECT id FROM activity WHERE action = ? AND timestamp = ?",
-                    (row["Action"], row["Timestamp"]))
-            activity = c.fetchone()
-
-            # If the action is already in the activity table, this is not the first time the script is run.
-            if activity:
-                continue
+        # If the action is already in the activity table, this is not the first time the script is run.
+        activity = (row["Action"], row["Timestamp"])
+        
+        if activity in activities:
+            continue
+        
+        activities.add(activity)
+        
+        channel_id = channel_ids.get(row["Channel URL"])
+        
+        # If the channel doesn"t exist, insert it into the channels table.
+        if channel_id is None:
+            channel_id = next_channel_id
+            next_channel_id += 1
             
-            c.execute("SELECT id, url FROM channel WHERE url = ?", (row["Channel URL"],))
-            channel = c.fetchone()
+            channel_ids[row["Channel URL"]] = channel_id
+            new_channels.append((channel_id, row["Channel"].strip(), row["Channel URL"]))
+
+        video = (row["Title"], row["URL"])
+        video_id = video_ids.get(video)
+
+        # If the video doesn"t exist, insert it into the videos table.
+        if video_id is None:
+            video_id = next_video_id
+            next_video_id += 1
             
-            # If the channel doesn"t exist, insert it into the channels table.
-            if not channel:
-                channel_name = row["Channel"].strip()
-                
-                c.execute("""INSERT INTO channel (name, url)
-                            VALUES (?, ?)""", (channel_name , row["Channel URL"],))
-                channel_id = c.lastrowid
-                inserted_channels += 1
-            else:
-                channel_id = channel[0]
-
-            if "Title" in row and "URL" in row:
-                c.execute("SELECT id FROM video WHERE title = ? AND url = ?", (row["Title"], row["URL"]))
-                video = c.fetchone()
-
-                # If the video doesn"t exist, insert it into the videos table.
-                if not video:
-                    c.execute("""INSERT INTO video (title, url, channel_id)
-                                VALUES (?, ?, ?)""", (row.get("Title", None), row["URL"], channel_id))
-                    video_id = c.lastrowid
-                    inserted_videos += 1
-                else:
-                    video_id = video[0]
-
-            c.execute("""INSERT INTO activity (action, timestamp, video_id, channel_id)
-                        VALUES (?, ?, ?, ?)""", (row["Action"], row["Timestamp"], video_id, channel_id))
-            inserted_actions += 1
-
-        conn.commit()
-        
-        logger.info(f"Actions inserted: {inserted_actions}")
-        logger.info(f"Unique videos inserted: {inserted_videos}")
-        logger.info(f"Unique channels inserted: {inserted_channels}")
+            video_ids[video] = video_id
+            new_videos.append((video_id, row["Title"], row["URL"], channel_id))
 
-        if skipped_videos > 0:
-            logger.info(f"{skipped_videos} videos skipped because channels were defined as excluded")
+        new_activities.append((row["Action"], row["Timestamp"], video_id, channel_id))
 
+        if len(new_activities) >= batch_size:
+            insert_batch(c, new_channels, new_videos, new_activities)
+            
+            inserted_channels += len(new_channels)
+            inserted_videos += len(new_videos)
+            inserted_actions += len(new_activities)
+            
+            new_channels, new_videos, new_activities = [], [], []
 
-# Many streams are 10+ hours which mess up the watch time stats. 4 hours seemed to be a good average for me. 
-def delete_extra_long_videos(conn, c, max_length=4):
-    
-    min_length = max_length * 3600
-    excluded_condition = ''
+    insert_batch(c, new_channels, new_videos, new_activities)
     
-    if IMPORTANT_CHANNELS:
-        excluded_condition = f"AND channel.name NOT IN ({','.join('?' for _ in IMPORTANT_CHANNELS)})"
-    else:
-        excluded_condition = ''
-
-    query = f"""
-        DELETE FROM video
-        WHERE id IN (
-            SELECT video.id
-            FROM video
-            JOIN channel ON video.channel_id = channel.id
-            WHERE video.length > ?
-            {excluded_condition}
-            ORDER BY video.length DESC)
-    """
-
-    c.execute(query, [min_length] + IMPORTANT_CHANNELS)
+    inserted_channels += len(new_channels)
+    inserted_videos += len(new_videos)
+    inserted_actions += len(new_activities)
+
     conn.commit()
     
-    if c.rowcount > 0:
-        logger.info(f"Deleted {c.rowcount} extra long videos.")
+    logger.info(f"Actions inserted: {inserted_actions}")
+    logger.info(f"Unique videos inserted: {inserted_videos}")
+    logger.info(f"Unique channels inserted: {inserted_channels}")
 
+    if skipped_videos > 0:
+        logger.info(f"{skipped_videos} videos skipped because channels were defined as excluded")
 
-# Delete channels that have no videos and vice versa.
-def delete_orphans(conn, c):
+
+# Insert a batch of new channels, videos and activities. Channels go first so that the references are valid.
+def insert_batch(c, channels, videos, activities):
+
+    c.executemany("INSERT INTO channel (id, name, url) VALUES (?, ?, ?)", channels)
     
-    c.execute("DELETE FROM channel WHERE id NOT IN (SELECT DISTINCT channel_id FROM video)")
+    c.executemany("INSERT INTO video (id, title, url, channel_id) VALUES (?, ?, ?, ?)", videos)
     
-    rowcount = c.rowcount
+    c.executemany("""INSERT INTO activity (action, timestamp, video_id, channel_id)
+                    VALUES (?, ?, ?, ?)""", activities)
+
+
+# Many streams are 10+ hours which mess up the watch time stats. 4 hours seemed to be a good average for me. 
+def delete_extra_long_videos(conn, c, max_length=4):
     
-    c.execute("DELETE FROM activity WHERE channel_id NOT IN (SELECT id FROM channel)")
-    c.execute("DELETE FROM video WHERE channel_id NOT IN (SELECT id FROM channel)")
-    c.execute("DELETE FROM video_stat WHERE video_id NOT IN (SELECT id FROM video)")
-    c.execute("DELETE FROM channel_stat WHERE channel_id NOT IN (SELECT id FROM channel)")
-    conn.commit()
+    purge_database(conn, c, max_length=max_length)
+
+
+# Delete channels that have no videos and vice versa.
+def delete_orphans(conn, c):
     
-    if rowcount > 0:
-        logger.info(f"Deleted {c.rowcount} empty channels.")
\ No newline at end of file
+    purge_database(conn, c)
+
+
+# Deletes in one pass the excluded channels (CHANNELS_NOT_TO_IMPORT), videos longer than max_length hours
+# (except from IMPORTANT_CHANNELS), channels left without videos, and everything pointing to deleted or 
+# unavailable rows: activities, video stats and channel stats.
+# With dry_run nothing is deleted, which helps to tune max_length and CHANNELS_NOT_TO_IMPORT.
+# Returns the number of rows (to be) deleted per table.
+def purge_database(conn, c, max_length=None, dry_run=False):
+
+    for table in ["purge_channel", "purge_video", "purge_activity", "purge_video_stat", "purge_channel_stat"]:
+        c.execute(f"DROP TABLE IF EXISTS temp.{table}")
+        c.execute(f"CREATE TEMP TABLE {table} (id INTEGER PRIMARY KEY)")
+
+    # Excluded channels.
+    if CHANNELS_NOT_TO_IMPORT:
+        c.execute(f"""INSERT INTO purge_channel
+                      SELECT id FROM channel WHERE name IN ({",".join("?" for _ in CHANNELS_NOT_TO_IMPORT)})""",
+                  CHANNELS_NOT_TO_IMPORT)
+
+    # Extra long videos.
+    if max_length is not None:
+        important_condition = ""
+        
+        if IMPORTANT_CHANNELS:
+            important_condition = f"AND channel.name NOT IN ({','.join('?' for _ in IMPORTANT_CHANNELS)})"
+        
+        c.execute(f"""INSERT INTO purge_video
+                      SELECT video.id
+                      FROM video
+                      JOIN channel ON video.channel_id = channel.id
+                      WHERE video.length > ?
+                      {important_condition}""", [max_length * 3600] + IMPORTANT_CHANNELS)
+
+    # Videos of the excluded channels and videos whose channel is no longer available.
+    c.execute("""INSERT OR IGNORE INTO purge_video
+                 SELECT video.id FROM video JOIN purge_channel ON video.channel_id = purge_channel.id""")
+    c.execute("""INSERT OR IGNORE INTO purge_video
+                 SELECT video.id FROM video 
+                 WHERE NOT EXISTS (SELECT 1 FROM channel WHERE channel.id = video.channel_id)""")
+
+    # Channels that have no videos left.
+    c.execute("""INSERT OR IGNORE INTO purge_channel
+                 SELECT channel.id FROM channel
+                 WHERE NOT EXISTS (SELECT 1 FROM video 
+                                   WHERE video.channel_id = channel.id
+                                   AND NOT EXISTS (SELECT 1 FROM purge_video WHERE purge_video.id = video.id))""")
+
+    # Rows pointing to the purged or otherwise missing videos and channels.
+    c.execute("""INSERT OR IGNORE INTO purge_activity
+                 SELECT activity.id FROM activity JOIN purge_video ON activity.video_id = purge_video.id""")
+    c.execute("""INSERT OR IGNORE INTO purge_activity
+                 SELECT activity.id FROM activity JOIN purge_channel ON activity.channel_id = purge_channel.id""")
+    c.execute("""INSERT OR IGNORE INTO purge_activity
+                 SELECT activity.id FROM activity
+                 WHERE NOT EXISTS (SELECT 1 FROM video WHERE video.id = activity.video_id)
+                 OR NOT EXISTS (SELECT 1 FROM channel WHERE channel.id = activity.channel_id)""")
+
+    c.execute("""INSERT OR IGNORE INTO purge_video_stat
+                 SELECT video_stat.id FROM video_stat JOIN purge_video ON video_stat.video_id = purge_video.id""")
+    c.execute("""INSERT OR IGNORE INTO purge_video_stat
+                 SELECT video_stat.id FROM video_stat
+                 WHERE NOT EXISTS (SELECT 1 FROM video WHERE video.id = video_stat.video_id)""")
+
+    c.execute("""INSERT OR IGNORE INTO purge_channel_stat
+                 SELECT channel_stat.id FROM channel_stat JOIN purge_channel ON channel_stat.channel_id = purge_channel.id""")
+    c.execute("""INSERT OR IGNORE INTO purge_channel_stat
+                 SELECT channel_stat.id FROM channel_stat
+                 WHERE NOT EXISTS (SELECT 1 FROM channel WHERE channel.id = channel_stat.channel_id)""")
+
+    # The keywords of the purged videos and of the videos deleted earlier.
+    if not dry_run:
+        c.execute("""DELETE FROM video_keyword 
+                     WHERE video_id IN (SELECT id FROM temp.purge_video)
+                     OR NOT EXISTS (SELECT 1 FROM video WHERE video.id = video_keyword.video_id)""")
+
+    # The referencing rows are deleted first, so the result is the same with and without foreign keys.
+    counts = {}
+    for table in ["activity", "video_stat", "channel_stat", "video", "channel"]:
+        c.execute(f"SELECT COUNT(*) FROM temp.purge_{table}")
+        counts[table] = c.fetchone()[0]
+
+        if not dry_run and counts[table] > 0:
+            c.execute(f"DELETE FROM {table} WHERE id IN (SELECT id FROM temp.purge_{table})")
+
+    for table in counts:
+        c.execute(f"DROP TABLE temp.purge_{table}")
+
+    conn.commit()
+
+    summary = ", ".join(f"{count} {table} rows" for table, count in counts.items() if count > 0)
+
+    if dry_run:
+        logger.info(f"Purge dry run, would delete: {summary or 'nothing'}")
+    elif summary:
+        logger.info(f"Purged {summary}")
+
+    return counts
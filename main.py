@@ -1,21 +1,19 @@
-import os
-import sqlite3
-
-from convert_json_into_csv import convert_json_into_csv
 from create_database import create_database
-from dynamic_clustering import (clusterize, find_optimal_cluster_size,
+from db_connection import apply_profile, get_connection
+from dynamic_clustering import (assign_new_channels, clusterize,
+                                find_optimal_cluster_size,
                                 get_category_names_from_openai,
                                 update_category_keywords)
 from fixed_clustering import (categorize_remaining_channels,
                               get_category_keywords_from_openai_api,
                               set_fixed_categories)
-from import_data_into_db import (delete_extra_long_videos, delete_orphans,
-                                 insert_data_into_database)
+from import_data_into_db import import_json_into_database, purge_database
 from logger_setup import setup_logger
 from sql_queries import (show_most_watched_categories,
                          show_most_watched_channels)
 from update_keywords import update_channel_keywords, update_video_keywords
-from youtube_api import (get_youtube_client, save_channel_details,
+from youtube_api import (get_youtube_client, refresh_channel_stats,
+                         refresh_video_stats, save_channel_details,
                          save_video_details)
 
 logger = setup_logger()
@@ -26,38 +24,44 @@ def main():
     logger.info("=" * 30)
     logger.info("Starting the process...")
     
-    conn = sqlite3.connect(os.getenv("SQLITE_DB_FILE"))
+    conn = get_connection("bulk-load")
     c = conn.cursor()
 
     #============================================================
-    # STEP 1: Convert JSON file into CSV.
+    # STEP 1: Create SQLite database.
     #=============================================================
-    convert_json_into_csv()
+    create_database(conn, c)
     #============================================================
     
     
     #============================================================
-    # STEP 2: Create SQLite database and load CSV data there.
+    # STEP 2: Import JSON data into the database.
+    # Set write_csv=True to get the imported rows also in CSV_FILE for debugging.
     #=============================================================
-    create_database(conn, c)
-    insert_data_into_database(conn, c)
-    delete_extra_long_videos(conn, c, max_length=4)
-    delete_orphans(conn, c)
+    import_json_into_database(conn, c, write_csv=False)
+    # Use dry_run=True to see what would be deleted with the given max_length.
+    purge_database(conn, c, max_length=4)
     #============================================================
     
     
     #=============================================================
     # STEP 3. RETRIEVE VIDEO AND CHANNEL DETAILS FROM YOUTUBE API 
     #=============================================================
+    apply_profile(conn, "enrichment")
     youtube = get_youtube_client()     
     save_channel_details(youtube, conn, c)
     save_video_details(youtube, conn, c)
+    # The remaining quota is used to refresh the statistics of the videos and channels retrieved earlier.
+    # This is skipped in replay mode, the cached statistics are not today's.
+    refresh_channel_stats(youtube, conn, c)
+    refresh_video_stats(youtube, conn, c)
     #=============================================================
     
     
     #=============================================================
     # STEP 4. FIND SUITABLE KEYWORDS FOR VIDEOS AND CHANNELS
     #=============================================================
+    apply_profile(conn, "bulk-load")
     update_video_keywords(conn, c)
     update_channel_keywords(conn, c)
     #=============================================================
@@ -67,10 +71,14 @@ def main():
     # STEP 5 DYNAMIC CATEGORIZATION
     # You can let the app to divide the channels into categories 
     #=============================================================
-    cluster_size = find_optimal_cluster_size(c, k_max=10)
-    clusterize(conn, c, cluster_size) 
-    update_category_keywords(conn, c)
-    get_category_names_from_openai(conn, c)
+    # New channels are added to the existing categories. Set recluster
+    # to True to divide all the channels into new categories.
+    recluster = False
+    if recluster or not assign_new_channels(conn, c):
+        cluster_size = find_optimal_cluster_size(c, k_max=10)
+        clusterize(conn, c, cluster_size) 
+        update_category_keywords(conn, c)
+        get_category_names_from_openai(conn, c)
     #=============================================================
     
     #==========================================================
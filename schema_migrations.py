@@ -0,0 +1,302 @@
+import logging
+import sqlite3
+
+logger = logging.getLogger("app_logger")
+
+
+# The schema version is stored in SQLite's user_version. Each migration upgrades the database
+# by one version and is run only once. Add new migrations to the end of the list, never change old ones.
+def get_schema_version(c):
+    c.execute("PRAGMA user_version")
+    return c.fetchone()[0]
+
+
+def migrate_database(conn, c):
+
+    version = get_schema_version(c)
+
+    if version >= len(MIGRATIONS):
+        return
+
+    # Rebuilding a table would cascade deletes into the referencing tables if foreign keys were enforced.
+    c.execute("PRAGMA foreign_keys")
+    foreign_keys = c.fetchone()[0]
+    c.execute("PRAGMA foreign_keys = OFF")
+
+    try:
+        for target_version, migration in enumerate(MIGRATIONS, start=1):
+            if target_version <= version:
+                continue
+
+            logger.info(f"Migrating database to version {target_version}: {migration.__name__}")
+
+            # Each migration and the version bump are committed together.
+            c.execute("BEGIN")
+            try:
+                migration(c)
+                c.execute(f"PRAGMA user_version = {target_version}")
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+    finally:
+        c.execute(f"PRAGMA foreign_keys = {foreign_keys}")
+
+
+# Newest imported timestamp per watch history file, so that reruns can skip the already imported entries.
+def add_import_state_table(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS import_state (
+                    source TEXT PRIMARY KEY,
+                    last_timestamp DATETIME
+                )""")
+
+
+# Indexes for the lookups done during import, enrichment and cleanup.
+# Duplicates created by older versions are merged first so that the unique indexes can be created.
+def add_indexes_and_unique_constraints(c):
+
+    merge_duplicates(c, "channel", ["url"], [("video", "channel_id"), ("activity", "channel_id"), ("channel_stat", "channel_id")])
+    merge_duplicates(c, "video", ["title", "url"], [("activity", "video_id"), ("video_stat", "video_id")])
+    merge_duplicates(c, "activity", ["action", "timestamp"], [])
+    merge_duplicates(c, "video_stat", ["video_id", "timestamp"], [])
+    merge_duplicates(c, "channel_stat", ["channel_id", "timestamp"], [])
+
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS channel_url_idx ON channel (url)")
+    c.execute("CREATE INDEX IF NOT EXISTS channel_category_id_idx ON channel (category_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS video_title_url_idx ON video (title, url)")
+    c.execute("CREATE INDEX IF NOT EXISTS video_channel_id_idx ON video (channel_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS activity_action_timestamp_idx ON activity (action, timestamp)")
+    c.execute("CREATE INDEX IF NOT EXISTS activity_video_id_idx ON activity (video_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS activity_channel_id_idx ON activity (channel_id)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS video_stat_video_id_timestamp_idx ON video_stat (video_id, timestamp)")
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS channel_stat_channel_id_timestamp_idx ON channel_stat (channel_id, timestamp)")
+
+
+# Keeps the row with the lowest id for each key, points the references to it and deletes the other rows.
+def merge_duplicates(c, table, key_columns, references):
+
+    join_condition = " AND ".join(f"duplicate.{column} = keeper.{column}" for column in key_columns)
+    key_list = ", ".join(key_columns)
+
+    c.execute("DROP TABLE IF EXISTS temp.duplicate_map")
+    c.execute(f"""CREATE TEMP TABLE duplicate_map AS
+                  SELECT duplicate.id AS old_id, keeper.keep_id AS new_id
+                  FROM {table} duplicate
+                  JOIN (SELECT {key_list}, MIN(id) AS keep_id
+                        FROM {table}
+                        GROUP BY {key_list}
+                        HAVING COUNT(*) > 1) keeper ON {join_condition}
+                  WHERE duplicate.id <> keeper.keep_id""")
+
+    c.execute("SELECT COUNT(*) FROM temp.duplicate_map")
+    duplicate_count = c.fetchone()[0]
+
+    if duplicate_count > 0:
+        for referencing_table, column in references:
+            c.execute(f"""UPDATE {referencing_table}
+                          SET {column} = (SELECT new_id FROM temp.duplicate_map WHERE old_id = {referencing_table}.{column})
+                          WHERE {column} IN (SELECT old_id FROM temp.duplicate_map)""")
+
+        c.execute(f"DELETE FROM {table} WHERE id IN (SELECT old_id FROM temp.duplicate_map)")
+
+        logger.info(f"Merged {duplicate_count} duplicate rows in {table}")
+
+    c.execute("DROP TABLE temp.duplicate_map")
+
+
+# Deleting a category cascaded into its channels, which is never wanted when foreign keys are enforced.
+# SQLite can't alter a foreign key, so the channel table is rebuilt with ON DELETE SET NULL.
+def set_channel_category_null_on_delete(c):
+
+    c.execute("""CREATE TABLE channel_new (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT,
+                    url TEXT,
+                    description TEXT,
+                    keywords TEXT,
+                    category_id INTEGER,
+                    FOREIGN KEY (category_id) REFERENCES category(id) ON DELETE SET NULL
+                )""")
+
+    c.execute("""INSERT INTO channel_new (id, name, url, description, keywords, category_id)
+                 SELECT id, name, url, description, keywords, category_id FROM channel""")
+
+    c.execute("DROP TABLE channel")
+    c.execute("ALTER TABLE channel_new RENAME TO channel")
+
+    c.execute("CREATE UNIQUE INDEX channel_url_idx ON channel (url)")
+    c.execute("CREATE INDEX channel_category_id_idx ON channel (category_id)")
+
+
+# YouTube API quota units used per day, so that the enrichment can stop at the daily budget and resume the next day.
+def add_api_quota_table(c):
+    c.execute("""CREATE TABLE IF NOT EXISTS api_quota (
+                    day DATE PRIMARY KEY,
+                    units_used INTEGER NOT NULL DEFAULT 0
+                )""")
+
+
+# Keywords are updated only for the videos whose text or keyword settings changed, see update_keywords.py.
+# The triggers mark a channel stale when its set of videos or their keywords change.
+def add_keyword_tracking(c):
+
+    c.execute("ALTER TABLE video ADD COLUMN content_hash TEXT")
+    c.execute("ALTER TABLE video ADD COLUMN keywords_version TEXT")
+    c.execute("ALTER TABLE channel ADD COLUMN keywords_stale INTEGER NOT NULL DEFAULT 1")
+
+    c.execute("""CREATE TRIGGER IF NOT EXISTS video_insert_channel_keywords_stale AFTER INSERT ON video
+                 BEGIN
+                     UPDATE channel SET keywords_stale = 1 WHERE id = NEW.channel_id;
+                 END""")
+
+    c.execute("""CREATE TRIGGER IF NOT EXISTS video_delete_channel_keywords_stale AFTER DELETE ON video
+                 BEGIN
+                     UPDATE channel SET keywords_stale = 1 WHERE id = OLD.channel_id;
+                 END""")
+
+    c.execute("""CREATE TRIGGER IF NOT EXISTS video_update_channel_keywords_stale AFTER UPDATE OF keywords, channel_id ON video
+                 WHEN OLD.keywords IS NOT NEW.keywords OR OLD.channel_id IS NOT NEW.channel_id
+                 BEGIN
+                     UPDATE channel SET keywords_stale = 1 WHERE id IN (OLD.channel_id, NEW.channel_id);
+                 END""")
+
+
+# Video keywords as a term dictionary and a (video, term) table, so that the top keywords can be counted
+# in SQL. The keyword versions are reset, so that the next keyword update fills the tables for all videos.
+def add_term_tables(c):
+
+    c.execute("""CREATE TABLE IF NOT EXISTS term (
+                    id INTEGER PRIMARY KEY,
+                    word TEXT NOT NULL UNIQUE
+                )""")
+
+    c.execute("""CREATE TABLE IF NOT EXISTS video_keyword (
+                    video_id INTEGER NOT NULL,
+                    term_id INTEGER NOT NULL,
+                    PRIMARY KEY (video_id, term_id),
+                    FOREIGN KEY (video_id) REFERENCES video(id) ON DELETE CASCADE,
+                    FOREIGN KEY (term_id) REFERENCES term(id) ON DELETE CASCADE
+                ) WITHOUT ROWID""")
+
+    c.execute("CREATE INDEX IF NOT EXISTS video_keyword_term_id_idx ON video_keyword (term_id)")
+
+    c.execute("UPDATE video SET keywords_version = NULL")
+    c.execute("UPDATE channel SET keywords_stale = 1")
+
+
+# Full-text indexes over the video and channel texts, kept in sync with triggers. The tables use the
+# rows of video and channel as external content, so the texts are not stored twice.
+# The missing indexes and triggers are created, so this can be run any number of times. Nothing is done
+# if SQLite is built without FTS5, and the LIKE queries are used instead.
+def ensure_full_text_search(conn, c):
+
+    if not is_fts5_available(c):
+        logger.warning("SQLite has no FTS5 support, full-text search is not available")
+        return
+
+    c.execute("BEGIN")
+    try:
+        add_full_text_index(c, "video", ["title", "description", "tags", "keywords"])
+        add_full_text_index(c, "channel", ["name", "keywords"])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def is_fts5_available(c):
+
+    try:
+        c.execute("CREATE VIRTUAL TABLE temp.fts5_check USING fts5(text)")
+    except sqlite3.OperationalError:
+        return False
+
+    c.execute("DROP TABLE temp.fts5_check")
+
+    return True
+
+
+# Creates <table>_fts over the columns and the triggers that keep it in sync, if they don't exist.
+# The index is filled from the table when something had to be created.
+def add_full_text_index(c, table, columns):
+
+    names = [f"{table}_fts", f"{table}_fts_insert", f"{table}_fts_delete", f"{table}_fts_update"]
+    c.execute(f"SELECT COUNT(*) FROM sqlite_master WHERE name IN ({', '.join('?' * len(names))})", names)
+
+    if c.fetchone()[0] == len(names):
+        return
+
+    column_list = ", ".join(columns)
+    new_values = ", ".join(f"NEW.{column}" for column in columns)
+    old_values = ", ".join(f"OLD.{column}" for column in columns)
+
+    c.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {table}_fts USING fts5({column_list}, content='{table}', content_rowid='id')")
+
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table}
+                  BEGIN
+                      INSERT INTO {table}_fts (rowid, {column_list}) VALUES (NEW.id, {new_values});
+                  END""")
+
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table}
+                  BEGIN
+                      INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+                  END""")
+
+    c.execute(f"""CREATE TRIGGER IF NOT EXISTS {table}_fts_update AFTER UPDATE OF {column_list} ON {table}
+                  BEGIN
+                      INSERT INTO {table}_fts ({table}_fts, rowid, {column_list}) VALUES ('delete', OLD.id, {old_values});
+                      INSERT INTO {table}_fts (rowid, {column_list}) VALUES (NEW.id, {new_values});
+                  END""")
+
+    c.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+    logger.info(f"Full-text index {table}_fts created")
+
+
+# The URL of the newest imported entry, so that the import can check that the entry at the high-water mark
+# is in the file before skipping the older entries.
+def add_import_state_url(c):
+    c.execute("ALTER TABLE import_state ADD COLUMN last_url TEXT")
+
+
+MIGRATIONS = [
+    add_import_state_table,
+    add_indexes_and_unique_constraints,
+    set_channel_category_null_on_delete,
+    add_api_quota_table,
+    add_keyword_tracking,
+    add_term_tables,
+    add_import_state_url,
+]
+
+
+# The lookups that run once per row or per API result. Each of them should be answered from an index.
+HOT_QUERIES = [
+    "SELECT id FROM channel WHERE url = ?",
+    "SELECT id FROM video WHERE title = ? AND url = ?",
+    "SELECT id FROM video WHERE channel_id = ?",
+    "SELECT id FROM activity WHERE action = ? AND timestamp = ?",
+    "SELECT id FROM activity WHERE video_id = ?",
+    "SELECT id FROM activity WHERE channel_id = ?",
+    "SELECT id FROM video_stat WHERE video_id = ? AND timestamp = ?",
+    "SELECT id FROM channel_stat WHERE channel_id = ? AND timestamp = ?",
+    "SELECT term_id FROM video_keyword WHERE video_id = ?",
+    "SELECT video_id FROM video_keyword WHERE term_id = ?",
+]
+
+
+# Runs EXPLAIN QUERY PLAN for the hot queries and returns the ones that scan a whole table.
+def check_query_plans(c):
+
+    full_scans = []
+
+    for query in HOT_QUERIES:
+        params = [None] * query.count("?")
+        c.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        plan = [row[3] for row in c.fetchall()]
+
+        if any(step.startswith("SCAN") for step in plan):
+            full_scans.append((query, plan))
+            logger.warning(f"Query does not use an index: {query} ({'; '.join(plan)})")
+
+    return full_scans
@@ -1,6 +1,7 @@
-import pandas as pd
-
+# pandas is imported only for printing the tables, so that importing the queries stays fast.
 def show_most_watched_categories(conn):
+    import pandas as pd
+
     print("\nMOST WATCHED CATEGORIES")
     
     s = """
@@ -36,6 +37,8 @@ def show_most_watched_categories(conn):
     
 
 def show_most_watched_channels(conn):
+    import pandas as pd
+
     print("\nMOST WATCHED CHANNELS")
     s = """
     SELECT ROW_NUMBER() OVER (ORDER BY COUNT(video.id) DESC) AS "#",
@@ -1,11 +1,12 @@
+import hashlib
+import json
 import logging
+import os
 import re
 import string
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 
-import nltk
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
-from nltk.tokenize import word_tokenize
 from tqdm import tqdm
 
 logger = logging.getLogger("app_logger")
@@ -17,106 +18,257 @@ know,latest,life,like,line,live,look,los,love,medium,model,new,news,performance,
 online,youtube,channel,people,place,product,que,scene,service,short,start,state,subscribe,subscriber,\
 support,thanks,thing,tiktok,time,topic,tv,twitter,u,use,video,videos,want,watch,\
 welcome,world,year,youtube,youtube channel"
-       
-nltk.download("punkt")
-nltk.download("stopwords")
-nltk.download("wordnet")
 
-ENGLISH_STOPWORD = stopwords.words("english")
 CUSTOM_STOPWORDS = CUSTOM_STOP_WORDS.split(",") # For easier modification above.
 
+# The NLTK data needed for the keywords. NLTK is imported only when the keywords are updated, and the data
+# is not downloaded automatically. Install it once with: python -m nltk.downloader punkt stopwords wordnet
+NLTK_RESOURCES = {
+    "punkt": "tokenizers/punkt",
+    "stopwords": "corpora/stopwords",
+    "wordnet": "corpora/wordnet",
+}
+
+# How many processes tokenize the video texts in parallel, and how many videos are sent to a process at a time.
+KEYWORD_WORKERS = os.cpu_count() or 1
+KEYWORD_CHUNK_SIZE = 500
+
+# How many lemmatized words are remembered. Titles and descriptions repeat the same words a lot.
+LEMMA_CACHE_SIZE = 100000
+
+# Increase this when you change how the text is tokenized, so that the keywords of all videos are updated again.
+KEYWORD_NORMALIZER_VERSION = 1
+
+text_normalizer = None
+
 
 # Updates video.keywords from title and description fields.
-def update_video_keywords(conn, c, batch_size=1000):
-    c.execute("""SELECT id, title, description, tags FROM video WHERE title IS NOT NULL OR description IS NOT NULL""")
-    videos = c.fetchall()
+# Only the videos whose text (content_hash) or keyword settings (keywords_version) changed since the last run are tokenized.
+# With more than one worker the videos are tokenized in parallel processes, KEYWORD_CHUNK_SIZE videos at a time.
+# The results are the same as with one worker, and only this process writes into the DB.
+def update_video_keywords(conn, c, batch_size=1000, workers=KEYWORD_WORKERS):
+    c.execute("""SELECT id, title, description, tags, content_hash, keywords_version 
+                 FROM video WHERE title IS NOT NULL OR description IS NOT NULL""")
+
+    keywords_version = get_keywords_version()
+
+    videos = []
+    for video_id, title, description, tags, content_hash, version in c.fetchall():
+        text = get_keyword_text(title, description, tags)
+        text_hash = get_content_hash(text)
+
+        if text_hash != content_hash or version != keywords_version:
+            videos.append((video_id, text, text_hash))
+
+    if not videos:
+        logger.info("Video keywords are up to date")
+        return
 
     # Use parameterized queries
-    update_query = """UPDATE video SET keywords = ? WHERE id = ?"""
+    update_query = """UPDATE video SET keywords = ?, content_hash = ?, keywords_version = ? WHERE id = ?"""
 
     # Use a single SQL statement with multiple rows
     data = []
-    for video in tqdm(videos):
-        video_id = video[0]
-        taglist = video[3]
+    if workers > 1 and len(videos) > KEYWORD_CHUNK_SIZE:
+        chunks = [videos[i:i + KEYWORD_CHUNK_SIZE] for i in range(0, len(videos), KEYWORD_CHUNK_SIZE)]
 
-        # Use tags only if available
-        if taglist is not None:
-            tagwords = taglist.replace(",", " ")
-            cleaned = tokenize_text(tagwords)
-        else:
-            title = video[1]
-            description = video[2] or ""  # use empty string if description is None
-            cleaned = tokenize_text(title + " " + description)
+        with ProcessPoolExecutor(max_workers=workers) as executor, tqdm(total=len(videos)) as progress:
+            # map() returns the chunks in the original order.
+            for chunk_data in executor.map(tokenize_videos, chunks):
+                data.extend(chunk_data)
+                progress.update(len(chunk_data))
+    else:
+        data = tokenize_videos(tqdm(videos))
 
-        data.append((cleaned, video_id))
+    term_ids = get_term_ids(c)
 
     # Update the database in batches
     for i in range(0, len(data), batch_size):
         batch = data[i:i+batch_size]
-        c.executemany(update_query, batch)
+        c.executemany(update_query, [(cleaned, text_hash, keywords_version, video_id) 
+                                     for cleaned, text_hash, video_id in batch])
+        save_video_terms(c, batch, term_ids)
         conn.commit()
 
+    # Words that no video uses anymore.
+    c.execute("DELETE FROM term WHERE NOT EXISTS (SELECT 1 FROM video_keyword WHERE video_keyword.term_id = term.id)")
+    conn.commit()
+
     logger.info("Updated keywords for %d videos", len(data))
 
 
+# Returns the term dictionary as {word: term id}.
+def get_term_ids(c):
+    c.execute("SELECT word, id FROM term")
+    return dict(c.fetchall())
+
+
+# Replaces the video_keyword rows of the (keywords, content hash, video id) rows.
+# New words are added into the term table and term_ids.
+def save_video_terms(c, data, term_ids):
+
+    c.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM term")
+    next_term_id = c.fetchone()[0]
+
+    new_terms = []
+    video_terms = []
+    for cleaned, _, video_id in data:
+        for word in cleaned.split():
+            term_id = term_ids.get(word)
+
+            if term_id is None:
+                term_id = next_term_id
+                next_term_id += 1
+                term_ids[word] = term_id
+                new_terms.append((term_id, word))
+
+            video_terms.append((video_id, term_id))
+
+    c.executemany("INSERT INTO term (id, word) VALUES (?, ?)", new_terms)
+    c.executemany("DELETE FROM video_keyword WHERE video_id = ?", [(video_id,) for _, _, video_id in data])
+    c.executemany("INSERT OR IGNORE INTO video_keyword (video_id, term_id) VALUES (?, ?)", video_terms)
+
+
+# Returns the text the video keywords are made of.
+def get_keyword_text(title, description, tags):
+
+    # Use tags only if available
+    if tags is not None:
+        return tags.replace(",", " ")
+
+    # use empty string if title or description is None
+    return (title or "") + " " + (description or "")
+
+
+def get_content_hash(text):
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+# Changes when the stopwords or KEYWORD_NORMALIZER_VERSION change, so that all video keywords are updated again.
+def get_keywords_version():
+    settings = json.dumps([KEYWORD_NORMALIZER_VERSION, sorted(get_english_stopwords()), sorted(CUSTOM_STOPWORDS)])
+    return hashlib.sha256(settings.encode("utf-8")).hexdigest()[:16]
+
+
+# Returns (keywords, content hash, video id) for the (video id, text, content hash) rows. Runs also in the worker processes.
+def tokenize_videos(videos):
+    return [(tokenize_text(text), text_hash, video_id) for video_id, text, text_hash in videos]
+
+
 # Cleans the text from numbers, punctuation, stopwords, and lemmatizes the words
 def tokenize_text(text):
-    
-    text = text.lower()
-
-    # Remove special characters, numbers, and punctuation
-    text = "".join(c for c in text if c not in string.punctuation and not c.isdigit())
-
-    # Remove URLs
-    text = re.sub(r"http\S+", "", text)
-
-    tokens = word_tokenize(text)
-    
-    # Remove typical irrelevant words.
-    tokens = [word for word in tokens if word not in ENGLISH_STOPWORD]
-
-    # Remove single character words.
-    tokens = [word for word in tokens if len(word) > 1]
-    
-    # Change words to their root form
-    lemmatizer = WordNetLemmatizer()
-    tokens = [lemmatizer.lemmatize(word) for word in tokens]
-
-    # For some reason these words don't work well with the lemmatizer.
-    tokens = [word for word in tokens if word not in CUSTOM_STOPWORDS]
-    
-    # Remove duplicates
-    tokens = set(tokens)
-    text = " ".join(tokens)
-    return text
-
-
-# Updates channel.keywords from video.keywords. 
-# Browses through all videos of the channel and picks the most frequent words.
-def update_channel_keywords(conn, c):
-    c.execute("""SELECT c.id, GROUP_CONCAT(v.keywords, ' ') AS all_video_keywords 
+    return get_text_normalizer().normalize(text)
+
+
+# The normalizer is built once per process, also in the keyword worker processes.
+def get_text_normalizer():
+    global text_normalizer
+
+    if text_normalizer is None:
+        text_normalizer = TextNormalizer()
+
+    return text_normalizer
+
+
+# Checks that the NLTK data is installed locally. Nothing is downloaded.
+def ensure_nltk_resources():
+    import nltk
+
+    missing = []
+    for package, path in NLTK_RESOURCES.items():
+        try:
+            nltk.data.find(path)
+        except LookupError:
+            missing.append(package)
+
+    if missing:
+        raise LookupError(f"NLTK data not found: {', '.join(missing)}. "
+                          f"Install it with: python -m nltk.downloader {' '.join(missing)}")
+
+
+@lru_cache(maxsize=None)
+def get_english_stopwords():
+    ensure_nltk_resources()
+
+    from nltk.corpus import stopwords
+
+    return stopwords.words("english")
+
+
+# Removes punctuation and digits with str.translate. The table is filled on demand, because
+# str.isdigit() knows many more digits than string.digits.
+class PunctuationTable(dict):
+
+    def __missing__(self, code):
+        char = chr(code)
+        self[code] = None if char in string.punctuation or char.isdigit() else code
+        return self[code]
+
+
+# The setup of tokenize_text done once: stopword sets, the translation table, the URL pattern and
+# the lemmatizer with a cache for the repeating words.
+class TextNormalizer:
+
+    def __init__(self, english_stopwords=None, custom_stopwords=None, lemma_cache_size=LEMMA_CACHE_SIZE):
+        ensure_nltk_resources()
+
+        from nltk.stem import WordNetLemmatizer
+        from nltk.tokenize import word_tokenize
+
+        self.stopwords = frozenset(get_english_stopwords() if english_stopwords is None else english_stopwords)
+        self.custom_stopwords = frozenset(CUSTOM_STOPWORDS if custom_stopwords is None else custom_stopwords)
+        self.punctuation_table = PunctuationTable()
+        self.url_pattern = re.compile(r"http\S+")
+        self.word_tokenize = word_tokenize
+        self.lemmatize = lru_cache(maxsize=lemma_cache_size)(WordNetLemmatizer().lemmatize)
+
+    def normalize(self, text):
+
+        # Remove special characters, numbers, and punctuation
+        text = text.lower().translate(self.punctuation_table)
+
+        # Remove URLs
+        text = self.url_pattern.sub("", text)
+
+        # Remove typical irrelevant words and single character words, and change words to their root form.
+        tokens = [self.lemmatize(word) for word in self.word_tokenize(text)
+                  if word not in self.stopwords and len(word) > 1]
+
+        # For some reason these words don't work well with the lemmatizer.
+        # Duplicates are removed, and the words are kept in their original order, unlike with a set,
+        # whose order changes between processes.
+        tokens = dict.fromkeys(word for word in tokens if word not in self.custom_stopwords)
+
+        return " ".join(tokens)
+
+
+# Updates channel.keywords from the keywords of the channel's videos. 
+# The most frequent words are counted from the video_keyword table.
+# Only the channels marked stale are updated. The DB triggers mark a channel stale when its videos
+# are added or deleted or their keywords change.
+def update_channel_keywords(conn, c, max_keywords=7):
+    c.execute("""SELECT c.id, COUNT(v.id) AS video_count
                  FROM channel c LEFT JOIN video v ON c.id = v.channel_id 
+                 WHERE c.keywords_stale = 1
                  GROUP BY c.id""")
     channel_data = c.fetchall()
 
     # Use parameterized queries
-    update_query = """UPDATE channel SET keywords = ? WHERE id = ?"""
+    update_query = """UPDATE channel SET keywords = ?, keywords_stale = 0 WHERE id = ?"""
 
     total_rows_affected = 0
-    for channel in tqdm(channel_data):
-        channel_id = channel[0]
-        all_video_keywords = channel[1]
+    for channel_id, video_count in tqdm(channel_data):
         
-        if all_video_keywords is None:
+        if video_count == 0:
             logger.info("Channel %s has no videos", channel_id)
+            c.execute("UPDATE channel SET keywords_stale = 0 WHERE id = ?", (channel_id,))
             continue
         
         # Get top keywords collected from all videos of the channel
-        top_words = extract_top_keywords(all_video_keywords, max_keywords=7)
+        top_words = get_top_channel_terms(c, channel_id, max_keywords=max_keywords)
 
         # Use a parameterized query to update the channel keywords
-        c.execute(update_query, (top_words, channel_id))
+        c.execute(update_query, (" ".join(top_words), channel_id))
         rows_affected = c.rowcount
         total_rows_affected += rows_affected
 
@@ -125,23 +277,15 @@ def update_channel_keywords(conn, c):
     logger.info("Updated keywords for %d channels", total_rows_affected)
 
 
-# Extracts most frequent words from the given text.
-def extract_top_keywords(text, max_keywords=10):
-    
-    # Remove punctuation and convert to lowercase.
-    text = re.sub(r"[^\w\s]", "", text).lower()
-
-    # Split text into words and count frequencies.
-    words = text.split()
-    freq = {}
-    for word in words:
-        if word in freq:
-            freq[word] += 1
-        else:
-            freq[word] = 1
-
-    # Sort words by frequency and return the top n words.
-    sorted_words = sorted(freq.items(), key=lambda x: -x[1])
-    top_words = [word[0] for word in sorted_words[:max_keywords]]
+# Returns the words used in most videos of the channel. Ties are ordered alphabetically.
+def get_top_channel_terms(c, channel_id, max_keywords=10):
+    c.execute("""SELECT term.word, COUNT(*) AS n
+                 FROM video
+                 JOIN video_keyword ON video_keyword.video_id = video.id
+                 JOIN term ON term.id = video_keyword.term_id
+                 WHERE video.channel_id = ?
+                 GROUP BY term.id
+                 ORDER BY n DESC, term.word
+                 LIMIT ?""", (channel_id, max_keywords))
 
-    return " ".join(top_words)
+    return [row[0] for row in c.fetchall()]
@@ -1,68 +1,118 @@
 import logging
 import os
-from datetime import date
-
-from googleapiclient.discovery import build
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from zoneinfo import ZoneInfo
+
+from api_cache import CACHE_MODES, CacheMiss, CachingYouTubeClient
+from fake_youtube_api import FakeYouTubeClient
 from tqdm import tqdm
 
 logger = logging.getLogger("app_logger")
 
-# YouTube API has a quota of 10,000 units per day, you may want to check that everything works before consuming it all.
-MAX_RESULTS = 10
+# YouTube API has a quota of 10,000 units per day. The used units are stored in the api_quota table, and
+# the enrichment stops when the budget is used and continues from the same point the next day.
+# You may want to use a small budget to check that everything works before consuming it all.
+DAILY_QUOTA_BUDGET = 9000
+
+# The quota resets at midnight Pacific time.
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")
+
+# Quota cost of one videos.list or channels.list request.
+LIST_REQUEST_COST = 1
+
+# videos.list and channels.list accept up to 50 ids per request.
+API_BATCH_SIZE = 50
+
+CHANNEL_URL_PREFIX = "https://www.youtube.com/channel/"
+
+# How many API requests are in flight at the same time.
+MAX_WORKERS = 4
+
+# How many batches are written into the DB before committing.
+COMMIT_EVERY_BATCHES = 10
+
+# Rate limits and server errors are retried with exponential backoff starting from RETRY_BASE_DELAY seconds.
+MAX_RETRIES = 5
+RETRY_BASE_DELAY = 1
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+# The statistics of already retrieved videos and channels are requested again when the latest
+# stored statistics are at least this many days old. The stats are stored max once a day.
+VIDEO_STATS_MAX_AGE_DAYS = 7
+CHANNEL_STATS_MAX_AGE_DAYS = 7
+
+thread_local = threading.local()
+
 
+# The client goes through the API response cache according to YOUTUBE_API_CACHE (off, record or replay, see api_cache.py).
+# With YOUTUBE_API_BACKEND=fake the local stand-in from fake_youtube_api.py is used without the cache.
+# The fake items overwrite the channel names and video details and delete the "missing" rows, so the fake is
+# refused unless FAKE_YOUTUBE_DB_FILE confirms that SQLITE_DB_FILE is a scratch database.
+def get_youtube_client(cache_mode=None):
 
-def get_youtube_client():
+    if os.getenv("YOUTUBE_API_BACKEND") == "fake":
+        db_file = os.getenv("SQLITE_DB_FILE")
+        scratch_db_file = os.getenv("FAKE_YOUTUBE_DB_FILE")
+
+        if not db_file or not scratch_db_file or os.path.abspath(db_file) != os.path.abspath(scratch_db_file):
+            raise ValueError("YOUTUBE_API_BACKEND=fake writes made up data into the database. "
+                             "Use a scratch database and set FAKE_YOUTUBE_DB_FILE to the same path as SQLITE_DB_FILE")
+
+        logger.info(f"Using the local fake YouTube API with the scratch database {db_file}")
+        return FakeYouTubeClient.from_env()
+
+    cache_mode = cache_mode or os.getenv("YOUTUBE_API_CACHE") or "record"
+
+    if cache_mode not in CACHE_MODES:
+        raise ValueError(f"Unknown YouTube API cache mode: {cache_mode}")
+
+    # Everything comes from the cache, so no API key is needed.
+    if cache_mode == "replay":
+        logger.info("Replaying YouTube API responses from the cache")
+        return CachingYouTubeClient(replay=True)
     
+    # The Google API client is slow to import, so it's imported only when the API is used.
+    from googleapiclient.discovery import build
+
     api_key = os.getenv("GOOGLE_API_KEY")
     youtube = build("youtube", "v3", developerKey=api_key)
+
+    if cache_mode == "record":
+        return CachingYouTubeClient(youtube)
     
     return youtube
 
 
 # Get channel URL from DB and call YouTube API to get more information to be stored in the DB.
 # The method can be run multiple times, it will only update the channels that are missing some information.
-def save_channel_details(youtube, conn, c):
+# The channels are requested in batches of API_BATCH_SIZE, the most watched channels first.
+# With rebuild all channels are requested again, for example to re-parse them from the API cache in replay mode.
+def save_channel_details(youtube, conn, c, quota_budget=DAILY_QUOTA_BUDGET, rebuild=False):
     
-    c.execute("SELECT id, url FROM channel WHERE description IS NULL LIMIT " + str(MAX_RESULTS))
-    channels = c.fetchall()
+    remaining_requests = get_remaining_requests(youtube, c, quota_budget)
 
-    total_channels = 0
-    deleted_channels = 0
-    for channel in tqdm(channels):
-        db_id = channel[0]
-        channel_url = channel[1]
-        
-        channel_id = channel_url.replace("https://www.youtube.com/channel/", "")
+    pending_condition = "1 = 1" if rebuild else "channel.description IS NULL"
 
-        try:
-            response = youtube.channels().list(
-                part="snippet,contentDetails,statistics",
-                id=channel_id
-            ).execute()
-
-            # If channel is not found from YouTube, delete it.
-            if response is None or response.get("items") is None or len(response["items"]) == 0:
-                c.execute("DELETE FROM channel WHERE id = ?", (db_id,))
-                deleted_channels += 1
-                conn.commit()
-                continue
-            
-            channel_title = response["items"][0]["snippet"]["title"]
-            channel_description = response["items"][0]["snippet"]["description"]
-            
-            stats = response["items"][0]["statistics"]
-            
-            c.execute("UPDATE channel SET name = ?, description = ? WHERE id = ?", 
-                      (channel_title, channel_description, db_id))
-                 
-            # Store also other channel stats into DB for future analysis.       
-            save_channel_stats(c, db_id, stats)
-            
-            conn.commit()
-            total_channels += 1
+    c.execute(f"""SELECT channel.id, channel.url 
+                  FROM channel 
+                  LEFT JOIN activity ON activity.channel_id = channel.id
+                  WHERE {pending_condition}
+                  GROUP BY channel.id
+                  ORDER BY COUNT(activity.id) DESC, channel.id
+                  LIMIT ?""", (get_row_limit(remaining_requests),))
+    channels = c.fetchall()
+
+    write = partial(write_channels, save_stats=has_live_statistics(youtube))
 
-        except IndexError:
-            logger.error(f"Channel {channel_url} could not be retrieved from YouTube")
+    total_channels, deleted_channels = fetch_and_save(youtube, conn, c, "channels", "snippet,contentDetails,statistics",
+                                                      channels, get_channel_id, parse_channel, write,
+                                                      quota_budget=quota_budget)
             
     logger.info(f"Updated {total_channels} channels from YouTube API")
     
@@ -77,85 +127,74 @@ def save_channel_details(youtube, conn, c):
         logger.info(f"Channels not yet updated: {count}")
 
 
-# Insert channel stats into DB.
-def save_channel_stats(c, db_id, stats):
-    
-    today = date.today()
-    c.execute("""SELECT id FROM channel_stat WHERE channel_id = ? AND timestamp = ?""", (db_id, today))
-    existing_stats = c.fetchone()
+# Returns the YouTube id from "https://www.youtube.com/channel/<id>".
+def get_channel_id(channel_url):
+    return channel_url.replace(CHANNEL_URL_PREFIX, "")
 
-    # Update stats only max once a day.
-    if existing_stats:
-        return
 
-    subscriber_count = stats["subscriberCount"]
-    video_count = stats["videoCount"]
-    view_count = stats["viewCount"]
-    
-    c.execute("INSERT INTO channel_stat (channel_id, timestamp, subscriber_count, video_count, view_count) VALUES (?, date(\"now\"), ?, ?, ?)",
-        (db_id, subscriber_count, video_count, view_count))
+# Returns the channel fields and statistics from a channels.list item.
+def parse_channel(channel):
+
+    channel_title = channel["snippet"]["title"]
+    channel_description = channel["snippet"]["description"]
+
+    return (channel_title, channel_description), channel["statistics"]
+
+
+def write_channels(c, found, missing, save_stats=True):
+
+    # If channel is not found from YouTube, delete it.
+    c.executemany("DELETE FROM channel WHERE id = ?", [(db_id,) for db_id in missing])
+
+    c.executemany("UPDATE channel SET name = ?, description = ? WHERE id = ?", 
+                  [fields + (db_id,) for db_id, (fields, stats) in found])
+
+    # Store also other channel stats into DB for future analysis.
+    if save_stats:
+        save_channel_stats(c, [(db_id, stats) for db_id, (fields, stats) in found])
+
+
+# Insert channel stats into DB. stats has (channel id, statistics) pairs.
+# The unique index on (channel_id, timestamp) keeps the stats max once a day.
+def save_channel_stats(c, stats):
+
+    c.executemany("""INSERT OR IGNORE INTO channel_stat (channel_id, timestamp, subscriber_count, video_count, view_count) 
+                     VALUES (?, date("now"), ?, ?, ?)""",
+                  [(db_id, stat.get("subscriberCount"), stat["videoCount"], stat["viewCount"]) for db_id, stat in stats])
 
 
 # Get video URL from DB and call YouTube API to retrieve video details.
-def save_video_details(youtube, conn, c):
+# The videos are requested in batches of API_BATCH_SIZE, which costs the same quota as a single video.
+# The most watched videos are requested first.
+# With rebuild all videos are requested again, for example to re-parse them from the API cache in replay mode.
+def save_video_details(youtube, conn, c, quota_budget=DAILY_QUOTA_BUDGET, rebuild=False):
     
+    remaining_requests = get_remaining_requests(youtube, c, quota_budget)
+
     # If video length is available, the data has already been retrieved.
-    # You can play with the LIMIT value when debugging.
-    c.execute("SELECT id, url FROM video WHERE length IS NULL LIMIT " + str(MAX_RESULTS))
+    pending_condition = "1 = 1" if rebuild else "video.length IS NULL"
+
+    c.execute(f"""SELECT video.id, video.url 
+                  FROM video 
+                  LEFT JOIN activity ON activity.video_id = video.id
+                  WHERE {pending_condition}
+                  GROUP BY video.id
+                  ORDER BY COUNT(activity.id) DESC, video.id
+                  LIMIT ?""", (get_row_limit(remaining_requests),))
     
     videos = c.fetchall()
 
-    deleted_videos = 0
-    total_videos = 0
-    for video in tqdm(videos):
-        video_id = video[0]
-        video_url = video[1]
-
-        try:
-            response = youtube.videos().list(
-                part="snippet,statistics,contentDetails",
-                id=video_url.split("=")[1]
-            ).execute()
-
-            # If video is not available in YouTube anymore, mark it as such in the DB.
-            if response is None or len(response["items"]) == 0:
-                deleted_videos += 1
-                c.execute("DELETE FROM video WHERE id = ?", (video_id,))
-                conn.commit()
-                continue
-            
-            video = response["items"][0]
-            duration = video["contentDetails"]["duration"]
-            description = video["snippet"]["description"]
-            published_at = video["snippet"]["publishedAt"]
-            
-            tags_list = None
-            tags = None
-            
-            if "tags" in video["snippet"]:
-                tags_list = video["snippet"]["tags"]
-            
-            if tags_list is not None:
-                tags = ",".join(tags_list)
-                
-            duration_tmp = parse_duration(duration)
-            length = time_to_seconds(duration_tmp)
-
-            c.execute("UPDATE video SET length = ?, description = ?, published_at = ?, tags = ? WHERE id = ?", (length, description, published_at, tags, video_id))
+    write = partial(write_videos, save_stats=has_live_statistics(youtube))
 
-            conn.commit()
-
-            save_video_stats(c, video_id, video["statistics"])
-            total_videos += 1
-            
-        except IndexError:
-            deleted_videos += 1
-    
-    # Commit the last row too
-    conn.commit()
+    total_videos, deleted_videos = fetch_and_save(youtube, conn, c, "videos", "snippet,statistics,contentDetails",
+                                                  videos, get_video_id, parse_video, write,
+                                                  quota_budget=quota_budget)
     
     logger.info(f"Updated {total_videos} videos from YouTube API")
 
+    if deleted_videos > 0:
+        logger.info(f"Deleted {deleted_videos} unavailable videos from DB")
+
     c.execute("SELECT COUNT(id) FROM video WHERE length IS NULL")
     
     count = c.fetchone()[0]
@@ -164,24 +203,392 @@ def save_video_details(youtube, conn, c):
         logger.info(f"Videos not yet updated: {count}")
 
 
+# Returns the YouTube id from "https://www.youtube.com/watch?v=<id>", or None if the URL has no id.
+def get_video_id(video_url):
+    try:
+        return video_url.split("=")[1]
+    except (AttributeError, IndexError):
+        return None
 
-# Additional status from the video, can maybe analysed later.
-def save_video_stats(c, video_id, stats):
+
+# Returns the video fields and statistics from a videos.list item.
+def parse_video(video):
+
+    duration = video["contentDetails"]["duration"]
+    description = video["snippet"]["description"]
+    published_at = video["snippet"]["publishedAt"]
+    
+    tags_list = None
+    tags = None
+    
+    if "tags" in video["snippet"]:
+        tags_list = video["snippet"]["tags"]
     
-    # Check if video stats for today have already been retrieved.
-    today = date.today()
-    c.execute("""SELECT id FROM video_stat WHERE video_id = ? AND timestamp = ?""", (video_id, today))
-    existing_stats = c.fetchone()
+    if tags_list is not None:
+        tags = ",".join(tags_list)
+        
+    duration_tmp = parse_duration(duration)
+    length = time_to_seconds(duration_tmp)
+
+    return (length, description, published_at, tags), video["statistics"]
+
+
+def write_videos(c, found, missing, save_stats=True):
+
+    # If video is not available in YouTube anymore, delete it from the DB.
+    c.executemany("DELETE FROM video WHERE id = ?", [(video_id,) for video_id in missing])
+
+    c.executemany("UPDATE video SET length = ?, description = ?, published_at = ?, tags = ? WHERE id = ?", 
+                  [fields + (video_id,) for video_id, (fields, stats) in found])
+
+    if save_stats:
+        save_video_stats(c, [(video_id, stats) for video_id, (fields, stats) in found])
+
+
+# Requests only the statistics of the videos retrieved earlier, so that video_stat gets a time series.
+# The videos whose latest stats are older than max_age_days are refreshed, the oldest first.
+def refresh_video_stats(youtube, conn, c, max_age_days=VIDEO_STATS_MAX_AGE_DAYS, quota_budget=DAILY_QUOTA_BUDGET):
+
+    if not has_live_statistics(youtube):
+        logger.info("Video statistics are not refreshed without the live YouTube API")
+        return
+
+    remaining_requests = get_remaining_requests(youtube, c, quota_budget)
+
+    c.execute("""SELECT video.id, video.url
+                 FROM video
+                 LEFT JOIN video_stat ON video_stat.video_id = video.id
+                 WHERE video.length IS NOT NULL
+                 GROUP BY video.id
+                 HAVING MAX(video_stat.timestamp) IS NULL OR MAX(video_stat.timestamp) <= date("now", ?)
+                 ORDER BY MAX(video_stat.timestamp), video.id
+                 LIMIT ?""", (get_stats_age_modifier(max_age_days), get_row_limit(remaining_requests)))
+
+    videos = c.fetchall()
+
+    refreshed_videos, missing_videos = fetch_and_save(youtube, conn, c, "videos", "statistics",
+                                                      videos, get_video_id, parse_statistics, write_video_stats,
+                                                      quota_budget=quota_budget)
+
+    logger.info(f"Refreshed statistics of {refreshed_videos} videos from YouTube API")
+
+    if missing_videos > 0:
+        logger.info(f"{missing_videos} videos were not found from YouTube, their statistics were not refreshed")
+
+
+# Requests only the statistics of the channels retrieved earlier, so that channel_stat gets a time series.
+def refresh_channel_stats(youtube, conn, c, max_age_days=CHANNEL_STATS_MAX_AGE_DAYS, quota_budget=DAILY_QUOTA_BUDGET):
+
+    if not has_live_statistics(youtube):
+        logger.info("Channel statistics are not refreshed without the live YouTube API")
+        return
+
+    remaining_requests = get_remaining_requests(youtube, c, quota_budget)
+
+    c.execute("""SELECT channel.id, channel.url
+                 FROM channel
+                 LEFT JOIN channel_stat ON channel_stat.channel_id = channel.id
+                 WHERE channel.description IS NOT NULL
+                 GROUP BY channel.id
+                 HAVING MAX(channel_stat.timestamp) IS NULL OR MAX(channel_stat.timestamp) <= date("now", ?)
+                 ORDER BY MAX(channel_stat.timestamp), channel.id
+                 LIMIT ?""", (get_stats_age_modifier(max_age_days), get_row_limit(remaining_requests)))
+
+    channels = c.fetchall()
+
+    refreshed_channels, missing_channels = fetch_and_save(youtube, conn, c, "channels", "statistics",
+                                                          channels, get_channel_id, parse_statistics, write_channel_stats,
+                                                          quota_budget=quota_budget)
 
-    # Update stats only max once a day.
-    if not existing_stats:
+    logger.info(f"Refreshed statistics of {refreshed_channels} channels from YouTube API")
+
+    if missing_channels > 0:
+        logger.info(f"{missing_channels} channels were not found from YouTube, their statistics were not refreshed")
+
+
+# The stats are stored with today's date, so they are not stored from a client with live_statistics = False.
+# A replaying client returns cached statistics, which would end up in the time series as today's values.
+def has_live_statistics(youtube):
+    return getattr(youtube, "live_statistics", True)
+
+
+# Returns the SQLite date modifier for the staleness threshold. Less than a day would break the once a day rule.
+def get_stats_age_modifier(max_age_days):
+    return f"-{max(1, max_age_days)} days"
+
+
+def parse_statistics(item):
+    return item["statistics"]
+
+
+# Only the stats are stored. Unavailable videos and channels are kept, they are handled by save_*_details.
+def write_video_stats(c, found, missing):
+    save_video_stats(c, found)
+
+
+def write_channel_stats(c, found, missing):
+    save_channel_stats(c, found)
+
+
+# Fetches the rows (db id, url) from the YouTube API in batches of API_BATCH_SIZE ids and passes the
+# parsed items to write(c, found, missing). found has (db id, parse_item(item)) pairs and missing has the
+# db ids that YouTube didn't return. 
+# Up to `workers` requests run in parallel threads, but only this thread writes into the DB,
+# committing every COMMIT_EVERY_BATCHES batches. A batch that fails even after retries, or has an item
+# that parse_item() can't parse, is left for the next run.
+# No more requests are sent than the daily quota_budget allows.
+# Returns the number of found and missing rows.
+def fetch_and_save(youtube, conn, c, resource, part, rows, get_api_id, parse_item, write, workers=MAX_WORKERS,
+                   quota_budget=DAILY_QUOTA_BUDGET):
+    from googleapiclient.errors import HttpError
+    from httplib2 import HttpLib2Error
+
+    found_count = 0
+    missing_count = 0
+    failed_batches = 0
+
+    # The same video may be in the DB many times, for example with different titles.
+    db_ids_by_api_id = {}
+    invalid_ids = []
+    for db_id, url in rows:
+        api_id = get_api_id(url)
+
+        if api_id:
+            db_ids_by_api_id.setdefault(api_id, []).append(db_id)
+        else:
+            invalid_ids.append(db_id)
+
+    if invalid_ids:
+        write(c, [], invalid_ids)
+        conn.commit()
+        missing_count += len(invalid_ids)
+
+    api_ids = list(db_ids_by_api_id)
+    batches = [api_ids[i:i + API_BATCH_SIZE] for i in range(0, len(api_ids), API_BATCH_SIZE)]
+
+    uses_quota = getattr(youtube, "uses_quota", True)
+    remaining_requests = get_remaining_requests(youtube, c, quota_budget)
+
+    if remaining_requests is not None and len(batches) > remaining_requests:
+        logger.info(f"Daily quota budget of {quota_budget} units is used after {remaining_requests} requests, "
+                    "the rest is retrieved on the next day")
+        batches = batches[:remaining_requests]
+
+    # Runs in the worker threads. Errors are returned with the number of requests sent, 
+    # because failed requests cost quota too.
+    def fetch(batch):
+        thread_local.requests = 0
         
-        view_count = stats.get("viewCount", 0)
-        like_count = stats.get("likeCount", 0)
-        comment_count = stats.get("commentCount", 0)
+        try:
+            request = getattr(youtube, resource)().list(
+                part=part,
+                id=",".join(batch),
+                maxResults=API_BATCH_SIZE
+            )
+            response = execute_with_retry(request)
+        except (HttpError, OSError, HttpLib2Error, CacheMiss) as e:
+            return None, None, thread_local.requests, e
+
+        items = {item["id"]: item for item in (response or {}).get("items") or []}
+
+        found = []
+        missing = []
+        for api_id in batch:
+            if api_id in items:
+                # An item without the expected fields fails the batch like an HTTP error.
+                try:
+                    parsed = parse_item(items[api_id])
+                except (KeyError, TypeError, ValueError) as e:
+                    return None, None, thread_local.requests, ValueError(f"Unexpected item {api_id}: {e!r}")
+
+                found.extend((db_id, parsed) for db_id in db_ids_by_api_id[api_id])
+            else:
+                missing.extend(db_ids_by_api_id[api_id])
+
+        return found, missing, thread_local.requests, None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fetch, batch) for batch in batches]
+
+        uncommitted_batches = 0
+        quota_exceeded = False
+        handled = 0
+        try:
+            for future in tqdm(futures):
+
+                # The requests that were not started after the quota ran out.
+                if future.cancelled():
+                    handled += 1
+                    continue
+
+                found, missing, requests, error = future.result()
+                handled += 1
+
+                if uses_quota:
+                    record_quota_usage(c, requests * LIST_REQUEST_COST)
+
+                if error is not None:
+                    if is_quota_exceeded(error):
+                        if not quota_exceeded:
+                            logger.error("YouTube API quota exceeded, the rest is retrieved on the next day")
+                            quota_exceeded = True
+
+                            # Don't try again today, even if the budget would allow it.
+                            record_quota_usage(c, max(0, quota_budget - get_quota_used(c)))
+
+                            for pending in futures:
+                                pending.cancel()
+                        continue
+
+                    logger.error(f"Retrieving a batch of {resource} from YouTube failed: {error}")
+                    failed_batches += 1
+                    continue
+
+                write_batch(conn, c, write, found, missing)
+                uncommitted_batches += 1
+
+                if uncommitted_batches >= COMMIT_EVERY_BATCHES:
+                    conn.commit()
+                    uncommitted_batches = 0
+
+                found_count += len(found)
+                missing_count += len(missing)
+        except BaseException:
+            # Don't send the batches that haven't started. The quota of the requests already sent and
+            # the batches fully written are committed before the error is raised.
+            executor.shutdown(cancel_futures=True)
+
+            if uses_quota:
+                for future in futures[handled:]:
+                    if not future.cancelled() and future.exception() is None:
+                        record_quota_usage(c, future.result()[2] * LIST_REQUEST_COST)
+
+            conn.commit()
+            raise
+
+    conn.commit()
+
+    if failed_batches > 0:
+        logger.info(f"{failed_batches} batches of {resource} failed and are retried on the next run")
+
+    return found_count, missing_count
+
+
+# Writes one batch inside a savepoint. A batch that fails halfway, for example with its deletes done but
+# not its updates, is rolled back, so that it is not committed with the earlier batches.
+def write_batch(conn, c, write, found, missing):
+
+    # Releasing a savepoint outside a transaction would commit it right away.
+    if not conn.in_transaction:
+        c.execute("BEGIN")
+
+    c.execute("SAVEPOINT write_batch")
+    try:
+        write(c, found, missing)
+    except BaseException:
+        c.execute("ROLLBACK TO write_batch")
+        c.execute("RELEASE write_batch")
+        raise
+
+    c.execute("RELEASE write_batch")
+
+
+# Executes the API request, retrying with exponential backoff on rate limits, server and network errors.
+def execute_with_retry(request, max_retries=MAX_RETRIES):
+    from googleapiclient.errors import HttpError
+    from httplib2 import HttpLib2Error
+
+    for attempt in range(max_retries + 1):
+        thread_local.requests = getattr(thread_local, "requests", 0) + 1
         
-        c.execute("""INSERT INTO video_stat (video_id, timestamp, view_count, like_count, comment_count)
-                    VALUES (?, date("now"), ?, ?, ?)""", (video_id, view_count, like_count, comment_count))
+        try:
+            return request.execute(http=get_thread_http())
+        except (HttpError, OSError, HttpLib2Error) as e:
+            if attempt == max_retries or not is_retryable(e):
+                raise
+
+            delay = RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 1)
+            logger.warning(f"YouTube API request failed ({e}), retrying in {delay:.1f} s")
+            time.sleep(delay)
+
+
+# Returns the quota day, which changes at midnight Pacific time.
+def get_quota_day():
+    return datetime.now(QUOTA_TIMEZONE).date().isoformat()
+
+
+def get_quota_used(c):
+
+    c.execute("SELECT units_used FROM api_quota WHERE day = ?", (get_quota_day(),))
+    result = c.fetchone()
+
+    return result[0] if result else 0
+
+
+def record_quota_usage(c, units):
+
+    if units <= 0:
+        return
+
+    c.execute("""INSERT INTO api_quota (day, units_used) VALUES (?, ?)
+                 ON CONFLICT (day) DO UPDATE SET units_used = units_used + excluded.units_used""",
+              (get_quota_day(), units))
+
+
+# Returns how many list requests can still be sent today within the budget, or None if the client uses no quota.
+def get_remaining_requests(youtube, c, quota_budget=DAILY_QUOTA_BUDGET):
+
+    if not getattr(youtube, "uses_quota", True):
+        return None
+
+    return max(0, quota_budget - get_quota_used(c)) // LIST_REQUEST_COST
+
+
+# Returns the max number of rows to select for the remaining requests. SQLite treats -1 as no limit.
+def get_row_limit(remaining_requests):
+    return -1 if remaining_requests is None else remaining_requests * API_BATCH_SIZE
+
+
+# The HTTP connections of the API client can't be shared between threads, so each thread has its own.
+def get_thread_http():
+
+    if not hasattr(thread_local, "http"):
+        from googleapiclient.http import build_http
+        thread_local.http = build_http()
+
+    return thread_local.http
+
+
+def get_error_reason(error):
+
+    try:
+        return error.error_details[0]["reason"]
+    except (AttributeError, IndexError, KeyError, TypeError):
+        return None
+
+
+def is_quota_exceeded(error):
+    from googleapiclient.errors import HttpError
+    return isinstance(error, HttpError) and get_error_reason(error) == "quotaExceeded"
+
+
+def is_retryable(error):
+    from googleapiclient.errors import HttpError
+
+    if not isinstance(error, HttpError):
+        return True
+
+    return error.resp.status in RETRY_STATUS_CODES or get_error_reason(error) in RATE_LIMIT_REASONS
+
+
+# Additional status from the video, can maybe analysed later.
+# stats has (video id, statistics) pairs. The unique index on (video_id, timestamp) keeps the stats max once a day.
+def save_video_stats(c, stats):
+    
+    c.executemany("""INSERT OR IGNORE INTO video_stat (video_id, timestamp, view_count, like_count, comment_count)
+                    VALUES (?, date("now"), ?, ?, ?)""", 
+                  [(video_id, stat.get("viewCount", 0), stat.get("likeCount", 0), stat.get("commentCount", 0))
+                   for video_id, stat in stats])
         
     
 # Convert YouTube "P54DT22H32M59S" duration format into HH:MM:SS format